@@ -3,15 +3,19 @@ This module handles the creation of the application's instance
 Various extensions are initialized and configuration settings are also attached
 """
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from config import Config
 from flask_migrate import Migrate
 from flask_ckeditor import CKEditor
+from werkzeug.middleware.proxy_fix import ProxyFix
+from app.cache import TTLCache, make_cache, make_response_cache
+from app.database import Database
+from app.passwords import PasswordHasher
+from app.ratelimit import RateLimiter
 
 
 # Create instances from the installed extensions
-db = SQLAlchemy()
+db = Database()
 migrate = Migrate(db, render_as_batch=True)
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -29,12 +33,32 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     # attach the configuration variables from the application
     app.config.from_object(Config)
+    # take the client's address and scheme from the headers of the proxies in front of the app,
+    # rather than the address of the last proxy, the rate limits are kept per client address
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
 
     # initialize objects derived from the extensions
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     ckeditor.init_app(app)
+    # cache of verified API tokens, saves a user lookup on every authenticated call
+    app.token_cache = TTLCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    # (monotonic time loaded, {user id: revocation timestamp}), see app.api.v1.routes.users
+    app.token_revocations = (float('-inf'), {})
+    # column values of the users logged in to the web interface, see app.identity
+    app.identity_cache = TTLCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    # cache of serialized responses of the public book endpoints
+    app.response_cache = make_response_cache(app.config)
+    # clients that wrote within the last REPLICA_STICKY_SECONDS, who read from the primary, see app.database
+    app.recent_writers = make_cache(app.config['REPLICA_STICKY_BACKEND'], app.config['REPLICA_STICKY_PATH'],
+                                    app.config['REPLICA_STICKY_SIZE'], app.config['REPLICA_STICKY_SECONDS'])
+    # hashes and checks passwords in a bounded process pool
+    app.password_hasher = PasswordHasher(app.config)
+    # token buckets of the rate limited endpoints
+    app.rate_limiter = RateLimiter(app.config)
 
     # register blueprints to the application
     from app.auth import bp as auth_bp
@@ -55,4 +79,14 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    # resolve the users of web sessions through the identity cache
+    from app.identity import load_user, request_principals
+    login.user_loader(load_user)
+    # remember API clients that wrote by name, so they read their writes from the primary
+    db.principals_loader(request_principals)
+
+    # attach the custom flask commands
+    from app import cli
+    cli.register(app)
+
     return app
@@ -1,17 +1,31 @@
 """
 A module with routes associated to the auth blueprint
 """
-import os
-import uuid
 import html
+from datetime import datetime
 from app import db
-from PIL import Image
 from app.models import Book, User
-from flask import current_app, flash, redirect, render_template, request, url_for, abort
+from flask import current_app, flash, jsonify, make_response, redirect, render_template, request, url_for, abort
 from flask_login import current_user, login_required
 from app.admin import bp
 from werkzeug.exceptions import RequestEntityTooLarge
 from app.admin.forms import AddBookForm, UpdateBookForm
+from app.images import cover_files, store_cover
+from app.jobs import enqueue
+from app.ratelimit import rate_limited, current_username
+from app.api.v1.pagination import decode_cursor, encode_cursor, sorted_page
+
+# The columns the dashboard lists
+DASHBOARD_COLUMNS = (Book.id, Book.title, Book.title_key, Book.author, Book.author_key, Book.year_of_publish,
+                     Book.copies_total, Book.copies_available, Book.updated_at)
+# The columns the dashboard sorts by and the type of their cursor values, each has a (column, id) index
+SORTS = {
+    'title': (Book.title_key, str),
+    'author': (Book.author_key, str),
+    'year': (Book.year_of_publish, int),
+    'updated': (Book.updated_at, datetime.fromisoformat),
+    'id': (Book.id, int),
+}
 
 
 def check_admin():
@@ -22,15 +36,85 @@ def check_admin():
         abort(404)
 
 
+def prefix_range(column, prefix):
+    """
+    returns a condition matching the values of column that start with prefix
+    Written as a range rather than a LIKE, so the column's index serves it under any collation
+    """
+    return db.and_(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+
+def dashboard_page():
+    """
+    Fetches the page of books the dashboard's query parameters ask for
+    title matches the start of titles, author and year match exactly, sort names one
+    of SORTS and order is 'asc' or 'desc', after is the cursor of the previous page
+    returns the books and the cursor of the next page, raises ValueError for malformed parameters
+    """
+    query = db.session.query(*DASHBOARD_COLUMNS)
+    title = Book.normalize(request.args.get('title'))
+    if title:
+        query = query.filter(prefix_range(Book.title_key, title))
+    author = Book.normalize(request.args.get('author'))
+    if author:
+        query = query.filter(Book.author_key == author)
+    if request.args.get('year'):
+        query = query.filter(Book.year_of_publish == int(request.args['year']))
+    sort = request.args.get('sort', 'title')
+    if sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+    column, value_type = SORTS[sort]
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    after = None
+    if request.args.get('after'):
+        after = decode_cursor(request.args['after'], value_type, int)
+    books, next_key = sorted_page(query, column, Book.id, current_app.config['ADMIN_PAGE_SIZE'], after,
+                                  descending=order == 'desc')
+    return books, encode_cursor(*next_key) if next_key is not None else None
+
+
 @bp.route('/admin')
 @login_required
 def admin():
     """
     The route that renders the admin dashboard
+    Only the first page of books is rendered, the dashboard fetches the next ones
+    from admin.books as the admin scrolls
+    """
+    check_admin()
+    try:
+        books, next_cursor = dashboard_page()
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('admin.admin'))
+    return render_template('admin/index.html', title="Admin", books=books, next_cursor=next_cursor)
+
+
+@bp.route('/books')
+@login_required
+def books():
+    """
+    The route that returns a page of the admin dashboard's books as JSON
     """
     check_admin()
-    books = Book.query.all()
-    return render_template('admin/index.html', title="Admin", books=books)
+    try:
+        books, next_cursor = dashboard_page()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    return jsonify({
+        'books': [{
+            'id': book.id,
+            'title': book.title,
+            'author': book.author,
+            'year_of_publish': book.year_of_publish,
+            'copies_total': book.copies_total,
+            'copies_available': book.copies_available,
+            'updated_at': book.updated_at.isoformat() if book.updated_at else None,
+        } for book in books],
+        'next': next_cursor,
+    })
 
 
 def save_image(image_file):
@@ -38,20 +122,15 @@ def save_image(image_file):
     Function that saves an image to the filesystem
     takes image as an arguement
     returns the image's filename
+    The upload is stored as is under a name derived from its content,
+    resizing it is left to the process_cover job
     """
-    # Generates random string and use it as image file name to ensure safe filenames
-    image_id = str(uuid.uuid4())
-    file_name = image_id + '.png'
-    # Get full path of the image
-    file_path = os.path.join(current_app.root_path, current_app.config['BOOK_IMAGES_DIR'], file_name)
-    # Utilize IMage module from PIL library to manipulate image_file
-    Image.open(image_file).save(file_path)
-    # Return file name so as to save it as image url in the db
-    return file_name
+    return store_cover(image_file)
 
 
 @bp.route('/add-book', methods=['GET', 'POST'])
 @login_required
+@rate_limited('write', current_username)
 def add_book():
     """
     A route that adds a book to the database
@@ -62,13 +141,20 @@ def add_book():
     try:
         if form.validate_on_submit():
             image = form.image.data
-            image_url = save_image(image)
+            try:
+                image_url = save_image(image)
+            except ValueError as e:
+                flash(f"The cover could not be used: {e}", "danger")
+                return render_template('books/create_book.html', title='Add a book', form=form)
             book = Book(title=form.title.data,
                         synopsis=html.unescape(form.synopsis.data),
                         author=form.author.data,
                         year_of_publish=form.year_of_publish.data,
                         img_url=image_url)
             db.session.add(book)
+            # get the book's id, the resizing job is queued in the same transaction
+            db.session.flush()
+            enqueue('process_cover', book_id=book.id)
             db.session.commit()
             flash(f"{book.title} has been succesfully added to the library", "success")
             return redirect(url_for('admin.admin'))
@@ -79,6 +165,7 @@ def add_book():
 
 @bp.route('/update/<id>', methods=['GET', 'POST'])
 @login_required
+@rate_limited('write', current_username)
 def update_book(id):
     """
     A route that updates the properties of a particular book in the database
@@ -103,25 +190,17 @@ def update_book(id):
     return render_template('books/update_book.html', title='Update book details', form=form)
 
 
-def delete_image(image_file):
-    """
-    Function that deletes a cover image from the file system
-    """
-    file_path = file_path = os.path.join(current_app.root_path, current_app.config['BOOK_IMAGES_DIR'], image_file)
-    os.remove(file_path)
-
-
 @bp.route('/delete-book/<id>', methods=['GET', 'DELETE'])
 @login_required
+@rate_limited('write', current_username, methods=('GET', 'DELETE'))
 def delete_book(id):
     """
     A route that handles deleting a book from the database
-    It also deletes the book's cover image as well
+    It also deletes the book's cover images as well
     """
     check_admin()
     book = Book.query.filter_by(id=id).first()
-    image_file = book.img_url
-    delete_image(image_file)
+    enqueue('delete_cover_files', file_names=cover_files(book))
     db.session.delete(book)
     db.session.commit()
     return redirect(url_for('admin.admin'))
@@ -0,0 +1,99 @@
+"""
+A module with the caching helpers of the API
+Responses built from the book catalog are tagged with the catalog version
+so clients can poll with If-None-Match and get an empty 304 while nothing changed,
+and are kept in the response cache under a key that includes that version
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import current_app, g, make_response, request
+from app.api import bp
+from app.models import Counter
+
+
+@bp.before_request
+def forget_catalog_version():
+    """
+    Makes sure every request reads the catalog version afresh
+    g outlives a request when an application context was already pushed
+    """
+    g.pop('catalog_version', None)
+
+
+def get_catalog_version():
+    """
+    Returns the catalog version and the time it last changed
+    The version is read once per request
+    """
+    if 'catalog_version' not in g:
+        g.catalog_version = Counter.catalog_version()
+    return g.catalog_version
+
+
+def catalog_etag(func):
+    """
+    decorator function that makes a catalog read endpoint conditional
+    The ETag is derived from the catalog version and everything in the request
+    that shapes the response, so it changes whenever either does
+    """
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        version, modified = get_catalog_version()
+        modified = modified.replace(tzinfo=timezone.utc, microsecond=0)
+        variant = f"{version}:{request.full_path}:{request.headers.get('Accept', '')}:".encode() + request.get_data()
+        etag = hashlib.sha1(variant).hexdigest()
+
+        # answer conditional requests before the view runs any query
+        # If-Modified-Since is not honoured, Last-Modified only has whole seconds and
+        # would hide a second write made within the same second as the first
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.last_modified = modified
+        # clients may keep the response but must revalidate it before reuse
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Accept')
+        return response
+    return wrapped
+
+
+def cached_response(key_func=None):
+    """
+    decorator function that serves a catalog read endpoint from the response cache
+    Responses are cached under the endpoint, its normalized parameters and the
+    catalog version, so any write to the books retires every cached response at once
+    key_func may return extra request details that shape the response, such as a body
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            cache = current_app.response_cache
+            # streams are never cached, they would have to be read whole first
+            if cache is None or request.args.get('stream') in ('1', 'true') or \
+                    request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+                return func(*args, **kwargs)
+
+            version, _ = get_catalog_version()
+            params = sorted(request.args.items(multi=True))
+            extra = key_func(*args, **kwargs) if key_func is not None else None
+            key = repr((request.endpoint, version, request.host, sorted(kwargs.items()), params, extra))
+
+            cached = cache.get(key)
+            if cached is not None:
+                status, headers, data = cached
+                response = make_response(data, status, headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(func(*args, **kwargs))
+            if response.status_code == 200:
+                headers = [(name, value) for name, value in response.headers.items() if name != 'Content-Length']
+                cache.set(key, (response.status_code, headers, response.get_data()))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapped
+    return decorator
@@ -0,0 +1,113 @@
+"""
+A module with helpers for keyset (cursor) pagination of API collections
+Every page is fetched with a single range scan on an indexed column
+so the cost of a page doesn't grow with how deep a client pages
+"""
+import base64
+import json
+import operator
+from flask import current_app, jsonify, request, url_for
+from sqlalchemy import tuple_
+
+
+def page_args():
+    """
+    Reads the limit and after query parameters from the current request
+    The limit is clamped to the server-side maximum page size
+    returns a (limit, after) tuple and raises ValueError for malformed values
+    """
+    limit = current_app.config['API_PAGE_SIZE']
+    if 'limit' in request.args:
+        limit = int(request.args['limit'])
+        if limit < 1:
+            raise ValueError('limit must be a positive integer')
+    limit = min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+
+    after = None
+    if 'after' in request.args:
+        after = int(request.args['after'])
+    return limit, after
+
+
+def keyset_page(query, column, limit, after=None):
+    """
+    Fetches a single page of a query ordered by column, starting after the cursor
+    One extra row is fetched to find out whether there is a following page
+    returns the items on the page and the cursor of the next page (None on the last page)
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    items = query.order_by(column).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = getattr(items[-1], column.key)
+    return items, next_cursor
+
+
+def encode_cursor(*values):
+    """
+    Packs the sort key of the last item on a page into an opaque, URL safe cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor, *types):
+    """
+    Unpacks a cursor made by encode_cursor, converting each value that isn't null with
+    the matching type
+    returns the list of values and raises ValueError for malformed cursors
+    """
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('malformed cursor')
+    # str would turn any JSON value into a string
+    if any(convert is str and not isinstance(value, (str, type(None))) for convert, value in zip(types, values)):
+        raise ValueError('malformed cursor')
+    try:
+        return [None if value is None else convert(value) for convert, value in zip(types, values)]
+    except (TypeError, OverflowError):
+        # well formed JSON holding values of the wrong type, e.g. an object for an id
+        raise ValueError('malformed cursor')
+
+
+def sorted_page(query, column, id_column, limit, after=None, descending=False):
+    """
+    Fetches a single page of a query ordered by a column that may hold nulls, ties broken by id
+    Rows with a value come first and rows without one last, each part is read with a
+    range scan over a (column, id) index rather than an OR the index can't serve
+    after is the (value, id) of the last item of the previous page
+    returns the items on the page and the (value, id) of the next page (None on the last page)
+    """
+    order = (column.desc(), id_column.desc()) if descending else (column, id_column)
+    follows = operator.lt if descending else operator.gt
+    items = []
+    if after is None or after[0] is not None:
+        valued = query.filter(column.isnot(None))
+        if after is not None:
+            valued = valued.filter(follows(tuple_(column, id_column), tuple_(*after)))
+        items = valued.order_by(*order).limit(limit + 1).all()
+    if len(items) <= limit:
+        nulls = query.filter(column.is_(None))
+        if after is not None and after[0] is None:
+            nulls = nulls.filter(follows(id_column, after[1]))
+        items += nulls.order_by(order[1]).limit(limit + 1 - len(items)).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = (getattr(items[-1], column.key), getattr(items[-1], id_column.key))
+    return items, next_cursor
+
+
+def paginated_response(key, items, next_cursor, limit):
+    """
+    Builds the JSON response for a page of serialized items
+    The cursor of the next page is returned in the body and as a Link header
+    """
+    response = jsonify({key: items, 'next': next_cursor})
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args.update(after=next_cursor, limit=limit)
+        next_url = url_for(request.endpoint, _external=True, **request.view_args, **args)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
@@ -1,71 +1,178 @@
 """
 A module that handles all default RESTful API actions for books
 """
-from flask import jsonify, request, make_response, abort
+import io
+from sqlalchemy.exc import IntegrityError
+from werkzeug.wsgi import get_input_stream
+from flask import jsonify, request, make_response, abort, Response, stream_with_context, json, current_app
 from app import db
-from app.models import Book
+from app.database import pool_stats
+from app.images import cover_files
+from app.importer import import_books
+from app.jobs import enqueue
+from app.models import Book, BookUnavailable, Counter, user_book, borrow, give_back
 from app.api import bp
 from app.api.v1.routes.users import check_for_token
+from app.ratelimit import rate_limited
+from app.api.v1.pagination import page_args, keyset_page, paginated_response
+from app.api.v1.caching import catalog_etag, cached_response
+from app.api.v1.serializers import book_fields, book_columns, load_book_fields, serialize_book
+
+
+def wants_stream():
+    """
+    Checks whether a client asked for the whole catalog as a stream
+    either through the stream parameter or by accepting newline delimited JSON
+    """
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def stream_books(fields, after=None):
+    """
+    Streams every book in the database as newline delimited JSON
+    Rows are read in batches through a server-side cursor as plain tuples
+    so memory stays flat however large the catalog is
+    """
+    query = db.session.query(*book_columns(fields))
+    if after is not None:
+        query = query.filter(Book.id > after)
+    query = query.order_by(Book.id).yield_per(current_app.config['API_STREAM_BATCH_SIZE'])
+
+    def generate():
+        for book in query:
+            yield json.dumps(serialize_book(book, fields)) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @bp.route('/books', methods=['GET'], strict_slashes=False)
+@catalog_etag
+@cached_response()
 def get_books():
     """
-    Retrieves all books from the database
+    Retrieves a page of books from the database
+    Pages are keyed on the book id, use the 'next' cursor as the 'after' parameter
+    The whole catalog is streamed instead when the client asks for it
     """
-    books = Book.query.all()
-    book_list = []
-    for book in books:
-        book_data = {
-            'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'synopsis': book.synopsis,
-            'Year of publishment': book.year_of_publish
-        }
-        book_list.append(book_data)
-    return jsonify({"books": book_list})
+    try:
+        limit, after = page_args()
+    except ValueError:
+        return make_response(jsonify({"error": "limit and after must be integers"}), 400)
+    try:
+        fields = book_fields()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    if wants_stream():
+        return stream_books(fields, after)
+    books, next_cursor = keyset_page(load_book_fields(Book.query, fields), Book.id, limit, after)
+    book_list = [serialize_book(book, fields) for book in books]
+    return paginated_response("books", book_list, next_cursor, limit)
 
 
 @bp.route('/books/count', methods=['GET'], strict_slashes=False)
+@catalog_etag
+@cached_response()
 def number_books():
     """
     Retrieves the total number of books in the database
+    The total is read from the book counter rather than counted
     """
-    book_count = Book.query.count()
+    book_count = Counter.value_of('book')
     return jsonify({"Total number of books": book_count})
 
 
+def author_key():
+    """
+    Returns the author a request to book_author asks for, as the client wrote it
+    The response echoes that name, so it is part of the cache key as is
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('author'), str):
+        return None
+    return data['author']
+
+
 @bp.route('/books/author', methods=['GET'], strict_slashes=False)
+@catalog_etag
+@cached_response(author_key)
 def book_author():
     """
     Retrieves books from a particular author in the db
     """
+    try:
+        fields = book_fields()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
     # check if request is json
     if request.is_json:
         # ensure author is passed as parameter
         if 'author' not in request.get_json():
             return make_response(jsonify({"error": "author name is missing"}), 400)
         author = request.json['author']
-        books = Book.query.filter_by(author=author).all()
+        books = load_book_fields(Book.query.filter_by(author_key=Book.normalize(author)), fields).all()
         book_count = len(books)
         if book_count == 0:
             return jsonify({"message": "A book by this author doesn't currently exist"})
-        books_list = []
-        for book in books:
-            book_data = {
-                'id': book.id,
-                'title': book.title,
-                'author': book.author,
-                'synopsis': book.synopsis,
-                'Year of publishment': book.year_of_publish
-            }
-            books_list.append(book_data)
+        books_list = [serialize_book(book, fields) for book in books]
         return jsonify({"author": author, "book_count": book_count, "books": books_list})
     else:
         return make_response(jsonify({"error": "Input not a JSON"}), 400)
 
 
+@bp.route('/books/search', methods=['GET'], strict_slashes=False)
+@catalog_etag
+def search_books():
+    """
+    Searches the titles, authors and synopses of books for the q parameter
+    Results are ranked by relevance and paginated with the page and per_page parameters
+    """
+    expression = request.args.get('q', '').strip()
+    if not expression:
+        return make_response(jsonify({"error": "search query is missing"}), 400)
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', current_app.config['API_PAGE_SIZE'], type=int)
+    if page < 1 or per_page < 1:
+        return make_response(jsonify({"error": "page and per_page must be positive integers"}), 400)
+    per_page = min(per_page, current_app.config['API_MAX_PAGE_SIZE'])
+    try:
+        fields = book_fields()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    query, total = Book.search(expression, page, per_page)
+    books_list = [serialize_book(book, fields) for book in load_book_fields(query, fields)]
+    return jsonify({"query": expression, "page": page, "total": total, "books": books_list})
+
+
+@bp.route('/cache/stats', methods=['GET'], strict_slashes=False)
+@check_for_token
+def cache_stats(current_user):
+    """
+    Returns the hit and miss counters of the response cache
+    """
+    if current_user is None or not current_user.is_admin:
+        return make_response(jsonify({"error": "action not allowed for this user"}), 403)
+    if current_app.response_cache is None:
+        return jsonify({"backend": None})
+    stats = current_app.response_cache.stats()
+    stats['backend'] = current_app.config['RESPONSE_CACHE_BACKEND']
+    return jsonify(stats)
+
+
+@bp.route('/db/stats', methods=['GET'], strict_slashes=False)
+@check_for_token
+def db_stats(current_user):
+    """
+    Returns the size and use of this worker's database connection pools, the replicas' included
+    """
+    if current_user is None or not current_user.is_admin:
+        return make_response(jsonify({"error": "action not allowed for this user"}), 403)
+    stats = pool_stats(db.engine)
+    stats['replicas'] = {bind: pool_stats(db.get_engine(bind=bind)) for bind in current_app.config['DATABASE_REPLICAS']}
+    return jsonify(stats)
+
+
 @bp.route('/books/mine', methods=['GET'], strict_slashes=False)
 @check_for_token
 def user_books(current_user):
@@ -75,42 +182,100 @@ def user_books(current_user):
     # handle the off chance that a user trying to consume this API is anonymous
     if current_user is None:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
-    books = current_user.borrowed_books
+    try:
+        fields = book_fields()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    query = Book.query.join(user_book).filter(user_book.c.user_id == current_user.id)
+    books = load_book_fields(query, fields).all()
     books_count = len(books)
     if books_count == 0:
         return jsonify({"message": "You haven't borrowed any book yet"})
-    books_list = []
-    for book in books:
-        book_data = {
-            'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'synopsis': book.synopsis,
-            'Year of publishment': book.year_of_publish
-        }
-        books_list.append(book_data)
+    books_list = [serialize_book(book, fields) for book in books]
     return jsonify({"books_count": books_count, "books": books_list})
 
 
+@bp.route('/books/<int:id>/loan', methods=['POST'], strict_slashes=False)
+@check_for_token
+def borrow_book(current_user, id):
+    """
+    Lends a book to the user making the request
+    Borrowing a book the user already holds changes nothing
+    """
+    if current_user is None:
+        return make_response(jsonify({"error": "action not allowed for this user"}), 403)
+    try:
+        borrowed = borrow(current_user.id, id)
+    except BookUnavailable as e:
+        db.session.rollback()
+        return make_response(jsonify({"error": str(e)}), 409)
+    if borrowed:
+        db.session.commit()
+        return make_response(jsonify({"Success": "Book succesfully borrowed"}), 201)
+    # nothing was inserted, either the loan exists already or the book doesn't
+    if db.session.query(Book.id).filter_by(id=id).first() is None:
+        return make_response(jsonify({"error": "Book does not exist"}), 404)
+    return make_response(jsonify({"Success": "Book already borrowed"}), 200)
+
+
+@bp.route('/books/<int:id>/loan', methods=['DELETE'], strict_slashes=False)
+@check_for_token
+def return_book(current_user, id):
+    """
+    Returns a book the user making the request has borrowed
+    """
+    if current_user is None:
+        return make_response(jsonify({"error": "action not allowed for this user"}), 403)
+    if not give_back(current_user.id, id):
+        return make_response(jsonify({"error": "You haven't borrowed this book"}), 404)
+    db.session.commit()
+    return make_response(jsonify({"Success": "Book succesfully returned"}), 200)
+
+
 @bp.route('/books/<string:title>', methods=['GET'], strict_slashes=False)
+@catalog_etag
+@cached_response()
 def get_book(title):
     """
     Returns information about a book with a particular title
     """
-    book = Book.query.filter_by(title=title).first()
+    try:
+        fields = book_fields()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    book = load_book_fields(Book.query.filter_by(title_key=Book.normalize(title)), fields).first()
     if book is None:
         return make_response(jsonify({"error": "Book does not exist"}), 404)
-    book_data = {
-        'id': book.id,
-        'title': book.title,
-        'author': book.author,
-        'synopsis': book.synopsis,
-        'Year of publishment': book.year_of_publish
-    }
-    return jsonify({"Book": book_data})
+    return jsonify({"Book": serialize_book(book, fields)})
+
+
+@bp.route('/books/bulk', methods=['POST'], strict_slashes=False)
+@rate_limited('write')
+@check_for_token
+def bulk_import(current_user):
+    """
+    Imports the books in the request body in batches
+    The body is streamed as CSV (text/csv) or JSON lines (application/x-ndjson)
+    """
+    if current_user is None or not current_user.is_admin:
+        return make_response(jsonify({"error": "action not allowed for this user"}), 403)
+    formats = {'text/csv': 'csv', 'application/x-ndjson': 'jsonl', 'application/jsonl': 'jsonl'}
+    if request.mimetype not in formats:
+        return make_response(jsonify({"error": "Input must be text/csv or application/x-ndjson"}), 415)
+    batch_size = request.args.get('batch_size', type=int)
+    if batch_size is not None and batch_size < 1:
+        return make_response(jsonify({"error": "batch_size must be a positive integer"}), 400)
+    # catalogs are far larger than MAX_CONTENT_LENGTH allows for uploads, this endpoint has a limit of its own
+    if request.content_length is not None and request.content_length > current_app.config['BULK_IMPORT_MAX_CONTENT_LENGTH']:
+        return make_response(jsonify({"error": "Request body is too large"}), 413)
+    body = get_input_stream(request.environ)
+    stream = io.TextIOWrapper(body, encoding=request.mimetype_params.get('charset', 'utf-8'), newline='')
+    report = import_books(stream, formats[request.mimetype], batch_size)
+    return make_response(jsonify(report.to_dict()), 201 if report.inserted else 200)
 
 
 @bp.route('/books/update/<string:title>', methods=['PUT'], strict_slashes=False)
+@rate_limited('write')
 @check_for_token
 def update_book(current_user, title):
     """
@@ -124,22 +289,37 @@ def update_book(current_user, title):
     if not current_user.is_admin:
         return make_response(jsonify({"error": "Action not allowed for this user"}), 403)
     if request.is_json:
-        book = Book.query.filter_by(title=title).first()
+        book = Book.query.filter_by(title_key=Book.normalize(title)).first()
         if book is None:
             return make_response(jsonify({"error": "Book does not exist"}), 404)
 
-        ignore = ['id', 'img_url']
+        ignore = ['id', 'img_url', 'title_key', 'author_key', 'copies_available', 'copies_total']
         data = request.get_json()
+        # everything is checked before the book is touched, so a rejected update changes nothing
+        copies_total = data.get('copies_total')
+        if 'copies_total' in data:
+            if isinstance(copies_total, bool) or not isinstance(copies_total, int) or copies_total < 0:
+                return make_response(jsonify({"error": "copies_total must be a non-negative integer"}), 400)
+            try:
+                book.set_copies_total(copies_total)
+            except ValueError as e:
+                return make_response(jsonify({"error": str(e)}), 400)
         for key, value in data.items():
             if key not in ignore:
                 setattr(book, key, value)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # copies were lent out meanwhile, leaving fewer than the new total allows
+            db.session.rollback()
+            return make_response(jsonify({"error": "copies_total is lower than the number of copies on loan"}), 409)
         return make_response(jsonify({"Success": "Book succesfully updated"}), 200)
     else:
         return make_response(jsonify({"error": "Input not a JSON"}), 400)
 
 
 @bp.route('/books/delete/<string:title>', methods=['DELETE'], strict_slashes=False)
+@rate_limited('write')
 @check_for_token
 def delete_book(current_user, title):
     """
@@ -150,10 +330,11 @@ def delete_book(current_user, title):
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
     if not current_user.is_admin:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
-    book = Book.query.filter_by(title=title).first()
+    book = Book.query.filter_by(title_key=Book.normalize(title)).first()
     if book is None:
         return make_response(jsonify({"error": "Book does not exist"}), 404)
 
+    enqueue('delete_cover_files', file_names=cover_files(book))
     db.session.delete(book)
     db.session.commit()
     return make_response(jsonify({"Success": "Book successfully deleted"}), 200)
@@ -3,17 +3,74 @@ A module that handles all default RESTful API actions for users
 """
 from flask import jsonify, request, make_response, current_app
 from app import db
-from app.models import User
+from app.models import User, Counter
+from app.identity import forget_user, revocations
 from app.api import bp
 import jwt
 from functools import wraps
 import datetime
+import time
+from app.api.v1.pagination import page_args, keyset_page, paginated_response
+from app.ratelimit import rate_limited
+
+
+class TokenPrincipal(object):
+    """
+    The identity behind a verified token
+    Holds just enough about a user for the API's authorization checks
+    """
+    __slots__ = ('id', 'name', 'is_admin')
+
+    def __init__(self, id, name, is_admin):
+        self.id = id
+        self.name = name
+        self.is_admin = bool(is_admin)
+
+    def __repr__(self):
+        """
+        Returns a string representation of a principal
+        """
+        return f"<TokenPrincipal_id: {self.id}, TokenPrincipal_name: {self.name}>"
+
+
+def verify_token(token):
+    """
+    Decodes a token and resolves the user it was issued to
+    Tokens carry the user's id, name and role, so verifying them needs no query,
+    and decoded tokens are cached until they expire
+    returns a TokenPrincipal, or None if the user's tokens were revoked or the user no longer exists
+    raises jwt.InvalidTokenError if the token is invalid and KeyError if it lacks claims
+    """
+    cached = current_app.token_cache.get(token)
+    if cached is None:
+        data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
+        if {'id', 'name', 'is_admin', 'iat'} <= data.keys():
+            principal = TokenPrincipal(data['id'], data['name'], data['is_admin'])
+        else:
+            # tokens issued before these claims existed are resolved against the database
+            if 'id' in data:
+                user = User.query.get(data['id'])
+            else:
+                user = User.query.filter_by(name=data['name']).first()
+            if user is None:
+                return None
+            principal = TokenPrincipal(user.id, user.name, user.is_admin)
+        cached = (principal, data.get('iat', 0))
+        # never keep a token in the cache beyond its own expiry
+        ttl = min(current_app.config['TOKEN_CACHE_TTL'], data['exp'] - time.time())
+        current_app.token_cache.set(token, cached, ttl)
+    principal, issued_at = cached
+    revoked_at = revocations().get(principal.id)
+    if revoked_at is not None and issued_at <= revoked_at:
+        return None
+    return principal
 
 
 # check for token and provide access to user with valid tokens only
 def check_for_token(func):
     """
     decorator function that works with the token
+    The wrapped route receives the TokenPrincipal the token belongs to
     """
     @wraps(func)
     # wrap function with any number of positional or keyword args
@@ -28,11 +85,9 @@ def check_for_token(func):
             return make_response(jsonify({"error": "token is missing"}), 401)
 
         try:
-            # decode the jwt token if it exists
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
-            # query the user in the db whom the token belongs to
-            current_user = User.query.filter_by(name=data['name']).first()
-        except Exception as e:
+            # resolve the user whom the token belongs to
+            current_user = verify_token(token)
+        except (jwt.InvalidTokenError, KeyError):
             # return token invalid error in case token does not match
             return make_response(jsonify({"error": "token is invalid"}), 401)
         # pass user object along with positional and kw args to the route in case token is correct
@@ -41,6 +96,7 @@ def check_for_token(func):
 
 
 @bp.route('/token', strict_slashes=False)
+@rate_limited('auth', lambda: request.authorization and request.authorization.username, methods=('GET',))
 def token():
     """
     route that enables users to get jwt tokens unique to each user
@@ -58,7 +114,17 @@ def token():
         return make_response(jsonify({"error": "User doesn't exist, please register first"}), 401, {'WWW-Authenticate': 'Basic realm="Login required"'})
 
     if user.check_password(auth.password):
-        token = jwt.encode({'name': user.name, 'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=30)}, current_app.config['SECRET_KEY'])
+        # keep the hash if check_password upgraded it
+        if db.session.is_modified(user):
+            db.session.commit()
+        token = jwt.encode({
+            'id': user.id,
+            'name': user.name,
+            'is_admin': bool(user.is_admin),
+            # a fractional issue time, so a token issued right after a revocation stays valid
+            'iat': time.time(),
+            'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=current_app.config['TOKEN_LIFETIME'])
+        }, current_app.config['SECRET_KEY'])
         return jsonify({'token': token})
     # return error if password is incorrect
     return make_response(jsonify({"error": "Verification has failed, password is incorrect"}), 401, {'WWW-Authenticate': 'Basic realm="Login required"'})
@@ -68,14 +134,19 @@ def token():
 @check_for_token
 def get_users(current_user):
     """
-    Retrieves all user account details
+    Retrieves a page of user account details
+    Pages are keyed on the user id, use the 'next' cursor as the 'after' parameter
     """
     # handle the off chance that a user trying to consume this API is anonymous
     if current_user is None:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
     if not current_user.is_admin:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
-    users = User.query.all()
+    try:
+        limit, after = page_args()
+    except ValueError:
+        return make_response(jsonify({"error": "limit and after must be integers"}), 400)
+    users, next_cursor = keyset_page(User.query, User.id, limit, after)
     user_list = []
     for user in users:
         user_data = {
@@ -84,7 +155,7 @@ def get_users(current_user):
             'email': user.email,
         }
         user_list.append(user_data)
-    return jsonify({"users": user_list})
+    return paginated_response("users", user_list, next_cursor, limit)
 
 
 @bp.route('/users/count', methods=['GET'], strict_slashes=False)
@@ -92,12 +163,13 @@ def get_users(current_user):
 def number_users(current_user):
     """
     Returns the total number of users in the database
+    The total is read from the user counter rather than counted
     """
     if current_user is None:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
     if not current_user.is_admin:
         return make_response(jsonify({"error": "action not allowed for this user"}), 403)
-    users_count = User.query.count()
+    users_count = Counter.value_of('user')
     return jsonify({"Total number of books": users_count})
 
 
@@ -123,8 +195,19 @@ def get_user(current_user, id):
     return jsonify({"User": user_data})
 
 
+def json_name():
+    """
+    returns the name a request to create_user signs up with, if it has one
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and isinstance(data.get('name'), str):
+        return data['name']
+    return None
+
+
 # create api route that creates a user account
 @bp.route('/user', methods=['POST'], strict_slashes=False)
+@rate_limited('auth', json_name)
 def create_user():
     """
     Creates a user in the database
@@ -148,6 +231,8 @@ def create_user():
         user.set_password(request.json['password'])
         db.session.add(user)
         db.session.commit()
+        # the new user's token request reads the account from the primary
+        db.add_principal(user.name)
         return make_response(jsonify({"Success": "User successfully registered"}), 201)
     else:
         return make_response(jsonify({"error": "Input not a JSON"}), 400)
@@ -171,9 +256,11 @@ def update_user(current_user):
         check_user = User.query.filter_by(name=request.json['name']).first()
         if check_email or check_user:
             return make_response(jsonify({"error": "An account with that username or email already exists"}), 400)
+        user = User.query.get(current_user.id)
         for key, value in data.items():
             if key not in ignore:
-                setattr(current_user, key, value)
+                setattr(user, key, value)
+        forget_user(user.id)
         db.session.commit()
         return make_response(jsonify({"Success": "User account succesfully updated"}), 200)
     else:
@@ -182,6 +269,7 @@ def update_user(current_user):
 
 # route that deletes a particular user account
 @bp.route('/user/<int:id>', methods=['DELETE'], strict_slashes=False)
+@rate_limited('write')
 @check_for_token
 def delete_user(current_user, id):
     """
@@ -197,5 +285,6 @@ def delete_user(current_user, id):
         return make_response(jsonify({"error": "User does not exist"}), 404)
 
     db.session.delete(user)
+    forget_user(id)
     db.session.commit()
     return make_response(jsonify({"Success": "User successfully deleted"}), 200)
@@ -0,0 +1,60 @@
+"""
+A module that turns model objects into the dictionaries returned by the API
+Clients can ask for a subset of fields with the fields parameter and only the
+matching columns are then loaded from the database
+"""
+from flask import request
+from sqlalchemy.orm import load_only
+from app.models import Book
+
+
+# Fields a client can ask for, mapped to the key used for them in responses
+BOOK_FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'author': 'author',
+    'synopsis': 'synopsis',
+    'year_of_publish': 'Year of publishment'
+}
+
+
+def book_fields():
+    """
+    Reads the fields parameter of the current request
+    returns the requested book fields, or all of them if none were requested
+    raises ValueError naming any field that doesn't exist
+    """
+    if not request.args.get('fields'):
+        return list(BOOK_FIELDS)
+    fields = []
+    for field in request.args['fields'].split(','):
+        field = field.strip()
+        if field and field not in fields:
+            fields.append(field)
+    unknown = [field for field in fields if field not in BOOK_FIELDS]
+    if unknown:
+        raise ValueError(f"unknown field(s): {', '.join(unknown)}")
+    return fields
+
+
+def book_columns(fields):
+    """
+    returns the Book columns backing a list of fields
+    """
+    return [getattr(Book, field) for field in fields]
+
+
+def load_book_fields(query, fields):
+    """
+    Restricts a Book query to the columns backing a list of fields
+    The primary key is always loaded alongside them
+    """
+    return query.options(load_only(*book_columns(fields)))
+
+
+def serialize_book(book, fields=BOOK_FIELDS):
+    """
+    Converts a book, or a row with the same attribute names, into a dictionary
+    holding only the requested fields
+    """
+    return {BOOK_FIELDS[field]: getattr(book, field) for field in fields}
@@ -8,9 +8,11 @@ from app.auth.forms import LoginForm, RegistrationForm
 from app.models import User
 from werkzeug.urls import url_parse
 from app import db
+from app.ratelimit import rate_limited
 
 
 @bp.route('/login', methods=['GET', 'POST'])
+@rate_limited('auth', lambda: request.form.get('username'))
 def login():
     """
     Route that handles logging users in
@@ -25,6 +27,9 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password', 'danger')
             return redirect(url_for('auth.login'))
+        # keep the hash if check_password upgraded it
+        if db.session.is_modified(user):
+            db.session.commit()
         login_user(user)
         # Refer admin to admin page if user is admin
         if current_user.is_admin:
@@ -40,6 +45,7 @@ def login():
 
 
 @bp.route('/register', methods=['GET', 'POST'])
+@rate_limited('auth', lambda: request.form.get('username'))
 def register():
     """
     Route that handles registration of new users to the system
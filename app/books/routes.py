@@ -1,12 +1,41 @@
 """
 A module that contains routes related to the book blueprint
 """
+import mimetypes
+import os
 from flask_login import current_user
 from app import db
-from flask import flash, redirect, render_template, request
-from app.models import Book, user_book, User
+from flask import abort, current_app, flash, make_response, redirect, render_template, request, send_from_directory
+from werkzeug.security import safe_join
+from app.images import images_dir
+from app.models import Book, BookUnavailable, borrow, current_loans, give_back
 from app.books import bp
 
+# Cover files are named after their content, so they may be cached for as long as browsers allow
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@bp.route('/covers/<path:filename>')
+def cover(filename):
+    """
+    A route that serves a book cover or one of its resized copies
+    The file is handed to the web server when COVERS_ACCEL_REDIRECT or USE_X_SENDFILE is set
+    """
+    accel_redirect = current_app.config['COVERS_ACCEL_REDIRECT']
+    if accel_redirect:
+        path = safe_join(images_dir(), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = accel_redirect.rstrip('/') + '/' + filename
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    else:
+        response = send_from_directory(images_dir(), filename, max_age=COVER_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = COVER_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
 
 @bp.route('/show-book/<id>')
 def show_book(id):
@@ -24,9 +53,12 @@ def borrow_book(id):
     A route that handles borrowing the book
     borrower's id and book's id is added to the user_book association table
     """
-    book = Book.query.filter_by(id=id).first()
-    user = User.query.filter_by(id=current_user.id).first()
-    user.borrowed_books.append(book)
+    try:
+        borrow(current_user.id, id)
+    except BookUnavailable:
+        db.session.rollback()
+        flash("All copies of this book are on loan, please try again later", "danger")
+        return redirect(request.referrer)
     db.session.commit()
     return redirect(request.referrer)
 
@@ -37,9 +69,7 @@ def return_book(id):
     A user can return a book they're done reading
     The route clears the book and user id from the association table
     """
-    book = Book.query.filter_by(id=id).first()
-    user = User.query.filter_by(id=current_user.id).first()
-    user.borrowed_books.remove(book)
+    give_back(current_user.id, id)
     db.session.commit()
     return redirect(request.referrer)
 
@@ -49,6 +79,6 @@ def my_books():
     """
     A route that renders a page showing all books borrowed by a particular user
     """
-    books = current_user.borrowed_books
+    books = [loan.book for loan in current_loans(current_user.id)]
     library = len(books)
     return render_template('books/my_books.html', books=books, library=library)
@@ -0,0 +1,190 @@
+"""
+A module with the caches used across the application
+"""
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    A bounded, thread-safe mapping whose entries expire after a time to live
+    The least recently used entry is dropped once the cache is full
+    """
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        returns the value stored under key, or default if it is missing or expired
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] <= time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key for ttl seconds, the cache's default ttl if none is given
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Removes key from the cache if it is there
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict(self, predicate):
+        """
+        Removes every entry whose value satisfies predicate
+        """
+        with self._lock:
+            stale = [key for key, (value, _) in self._data.items() if predicate(value)]
+            for key in stale:
+                del self._data[key]
+
+    def clear(self):
+        """
+        Removes every entry from the cache
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        returns the hit and miss counters along with the current size of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class SQLiteCache(object):
+    """
+    A bounded cache with expiring entries stored in a local SQLite file
+    Every worker process opening the same file shares its entries, which makes
+    it a drop-in replacement for TTLCache when running several gunicorn workers
+    The hit and miss counters are kept per process
+    """
+    def __init__(self, path, maxsize=1024, ttl=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache '
+                               '(key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_cache_accessed ON cache (accessed)')
+
+    def _connect(self):
+        """
+        returns the connection of the calling thread, opening it on first use
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            # let readers carry on while another worker writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, default=None):
+        """
+        returns the value stored under key, or default if it is missing or expired
+        """
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM cache WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            connection.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key for ttl seconds, the cache's default ttl if none is given
+        Expired entries, then the least recently used ones, make room once the cache is full
+        """
+        if ttl is None:
+            ttl = self.ttl
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                               (key, pickle.dumps(value), now + ttl, now))
+            size = connection.execute('SELECT count(*) FROM cache').fetchone()[0]
+            if size > self.maxsize:
+                connection.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+                connection.execute('DELETE FROM cache WHERE key IN '
+                                   '(SELECT key FROM cache ORDER BY accessed LIMIT max(0, (SELECT count(*) FROM cache) - ?))',
+                                   (self.maxsize,))
+
+    def delete(self, key):
+        """
+        Removes key from the cache if it is there
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        """
+        Removes every entry from the cache
+        """
+        with self._connect() as connection:
+            connection.execute('DELETE FROM cache')
+
+    def stats(self):
+        """
+        returns this process's hit and miss counters along with the current size of the cache
+        """
+        size = self._connect().execute('SELECT count(*) FROM cache').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+
+def make_cache(backend, path, maxsize, ttl):
+    """
+    Creates a cache of the given backend, 'memory' for one per worker and 'sqlite' for
+    one file shared by all workers
+    returns None when the backend is 'none'
+    """
+    if backend == 'memory':
+        return TTLCache(maxsize, ttl)
+    if backend == 'sqlite':
+        return SQLiteCache(path, maxsize, ttl)
+    if backend in (None, '', 'none'):
+        return None
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+def make_response_cache(config):
+    """
+    Creates the response cache backend chosen by the RESPONSE_CACHE_BACKEND setting
+    returns None when response caching is turned off
+    """
+    return make_cache(config['RESPONSE_CACHE_BACKEND'], config['RESPONSE_CACHE_PATH'],
+                      config['RESPONSE_CACHE_SIZE'], config['RESPONSE_CACHE_TTL'])
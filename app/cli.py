@@ -0,0 +1,126 @@
+"""
+A module with the application's custom flask commands
+"""
+import os
+from datetime import datetime
+import click
+
+
+def register(app):
+    """
+    Attaches the custom command groups to the application's cli
+    """
+    @app.cli.group()
+    def search():
+        """Full-text search index commands."""
+        pass
+
+    @search.command()
+    def reindex():
+        """Rebuild the search index from the database."""
+        from app.models import Book
+        Book.reindex()
+        click.echo('Search index rebuilt')
+
+    @app.cli.group()
+    def counters():
+        """Row counter commands."""
+        pass
+
+    @counters.command()
+    def reconcile():
+        """Recount the counted tables and correct any drift.
+
+        Meant to be run periodically, e.g. from cron or Heroku Scheduler.
+        """
+        from app.models import Counter
+        for name, value in Counter.reconcile().items():
+            click.echo(f'{name}: {value}')
+
+    @app.cli.group()
+    def books():
+        """Book catalog commands."""
+        pass
+
+    @books.command('import')
+    @click.argument('source', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'format', type=click.Choice(['csv', 'jsonl']),
+                  help='Input format, guessed from the file extension by default.')
+    @click.option('--batch-size', type=int, help='Number of books inserted per transaction.')
+    def import_books(source, format, batch_size):
+        """Import books from a CSV or JSON lines file, or - for stdin."""
+        from app.importer import import_books
+        if format is None:
+            extension = os.path.splitext(source.name)[1].lower()
+            format = 'csv' if extension == '.csv' else 'jsonl'
+        report = import_books(source, format, batch_size)
+        for error in report.errors:
+            click.echo(f"row {error['row']}: {error['error']}", err=True)
+        click.echo(f'{report.inserted} books imported, {report.error_count} rows rejected')
+
+    @app.cli.command('export')
+    @click.argument('directory', type=click.Path(file_okay=False))
+    @click.option('--format', 'format', type=click.Choice(['jsonl', 'csv']), default='jsonl',
+                  help='Format of the exported files.')
+    @click.option('--since', type=click.DateTime(),
+                  help='Only export books and users changed, and deleted, since this watermark (UTC).')
+    @click.option('--batch-size', type=int, default=1000, help='Number of rows fetched per round-trip.')
+    def export(directory, format, since, batch_size):
+        """Export books, users, loans and deletions to gzipped files in DIRECTORY.
+
+        Prints the watermark to pass as --since to the next incremental export.
+        """
+        from app.exporter import export_table, export_tables
+        # taken before reading so rows changed during the export are picked up next time
+        watermark = datetime.utcnow()
+        os.makedirs(directory, exist_ok=True)
+        for name in export_tables():
+            path, count = export_table(name, directory, format, since, batch_size)
+            click.echo(f'{count} {name} exported to {path}')
+        click.echo(f'watermark: {watermark.isoformat(timespec="seconds")}')
+
+    @app.cli.group()
+    def images():
+        """Book cover image commands."""
+        pass
+
+    @images.command()
+    @click.option('--workers', type=int, help='Number of worker processes, one per CPU by default.')
+    @click.option('--force', is_flag=True, help='Also rebuild covers that already have resized copies.')
+    @click.option('--batch-size', type=int, default=100, help='Number of books resized per commit.')
+    def rebuild(workers, force, batch_size):
+        """Create the resized copies of existing book covers."""
+        from app.images import rebuild_thumbnails
+        done, failed = rebuild_thumbnails(workers, force, batch_size)
+        for book_id, error in failed:
+            click.echo(f'book {book_id}: {error}', err=True)
+        click.echo(f'{done} covers resized, {len(failed)} failed')
+
+    @app.cli.group()
+    def loans():
+        """Loan ledger commands."""
+        pass
+
+    @loans.command()
+    @click.option('--batch-size', type=int, help='Number of overdue loans read per round-trip.')
+    def overdue(batch_size):
+        """Queue a reminder for every loan past its due date.
+
+        Meant to be run daily, e.g. from cron or Heroku Scheduler.
+        """
+        from app.loans import remind_overdue
+        click.echo(f'{remind_overdue(batch_size=batch_size)} overdue reminders queued')
+
+    @app.cli.group()
+    def jobs():
+        """Background job commands."""
+        pass
+
+    @jobs.command()
+    @click.option('--threads', type=int, default=4, help='Number of jobs run at once.')
+    @click.option('--poll-interval', type=float, default=1.0, help='Seconds to wait when no job is due.')
+    @click.option('--burst', is_flag=True, help='Exit once no job is due.')
+    def worker(threads, poll_interval, burst):
+        """Run queued background jobs."""
+        from app.jobs import work
+        work(threads, poll_interval, burst)
@@ -0,0 +1,187 @@
+"""
+A module that tunes the database engines of the application and routes reads to replicas
+Every engine is created with the pool settings of its kind of database, SQLite
+connections run the SQLITE_PRAGMAS as they open and PostgreSQL sessions get a
+statement timeout, so a runaway query can't hold a pooled connection for good
+The reads of GET requests go to one of the DATABASE_REPLICAS binds, except for
+clients that wrote within the last REPLICA_STICKY_SECONDS, who read their writes from the primary
+Clients are recognised by a cookie and, for API clients that don't send cookies back,
+by the names of the users they act for, kept in the app's recent_writers cache
+"""
+import random
+import time
+from flask import current_app, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+# Cookie holding the time until which a client that wrote reads from the primary
+STICKY_COOKIE = 'read_primary_until'
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends SELECTs to the replica picked for the request and everything else to the primary
+    The first write of a request sends the rest of it to the primary as well, so the
+    request reads what it wrote
+    """
+    def get_bind(self, mapper=None, clause=None):
+        """
+        Returns the engine a statement runs on
+        """
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = True
+            self.info['replica'] = None
+        replica = self.info.get('replica')
+        if replica is not None and getattr(clause, 'is_select', False) and \
+                getattr(clause, '_for_update_arg', None) is None and \
+                (mapper is None or mapper.persist_selectable.info.get('bind_key') is None):
+            return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """
+    The SQLAlchemy extension, creating engines with the DATABASE_* and SQLITE_* settings
+    Engines are made when first used, so the settings of the URL in use at that point apply
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.principals = lambda: []
+
+    def principals_loader(self, func):
+        """
+        Registers the function returning the names of the users the current request acts for
+        """
+        self.principals = func
+        return func
+
+    def add_principal(self, name):
+        """
+        Marks the current request as acting for a user it doesn't authenticate as, e.g. a
+        user it signs up, so that user's next requests read what this one wrote
+        """
+        self.session.info.setdefault('principals', set()).add(name.strip().casefold())
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """
+        Adds the pool and connection settings of the engine's kind of database to its options
+        """
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        config = app.config
+        if sa_url.drivername.startswith('sqlite'):
+            # a pool size of 0 keeps Flask-SQLAlchemy's connection per checkout
+            if sa_url.database not in (None, '', ':memory:') and config['DATABASE_POOL_SIZE']:
+                # keep connections open between requests, so their page cache and
+                # memory map survive, rather than reopening the file every time
+                options['poolclass'] = QueuePool
+                options['pool_size'] = config['DATABASE_POOL_SIZE']
+                options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+                options['pool_timeout'] = config['DATABASE_POOL_TIMEOUT']
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+            # picked up again by create_engine, create_engine of SQLAlchemy doesn't take it
+            options['sqlite_pragmas'] = config['SQLITE_PRAGMAS']
+        else:
+            options['pool_size'] = config['DATABASE_POOL_SIZE']
+            options['max_overflow'] = config['DATABASE_MAX_OVERFLOW']
+            options['pool_timeout'] = config['DATABASE_POOL_TIMEOUT']
+            options['pool_recycle'] = config['DATABASE_POOL_RECYCLE']
+            options['pool_pre_ping'] = config['DATABASE_POOL_PRE_PING']
+            if sa_url.drivername.startswith('postgresql') and config['DATABASE_STATEMENT_TIMEOUT']:
+                options.setdefault('connect_args', {})['options'] = \
+                    f"-c statement_timeout={config['DATABASE_STATEMENT_TIMEOUT']}"
+        return sa_url, options
+
+    def init_app(self, app):
+        """
+        Sets up the app and the request hooks that route its reads
+        """
+        super().init_app(app)
+        app.before_request(self.route_request)
+        app.after_request(self.remember_writes)
+        app.teardown_request(self.end_routing)
+
+    def create_session(self, options):
+        """
+        Creates the factory of the sessions, RoutingSessions instead of SignallingSessions
+        """
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def route_request(self):
+        """
+        Picks the replica the reads of the current request go to, if any
+        Only GET and HEAD requests of clients that haven't written lately read from a replica
+        """
+        replicas = current_app.config['DATABASE_REPLICAS']
+        principals = set()
+        replica = None
+        if replicas:
+            principals = {name.strip().casefold() for name in self.principals()}
+            if request.method in ('GET', 'HEAD') and not self.wrote_lately(principals):
+                replica = random.choice(replicas)
+        self.session.info.update(replica=replica, wrote=False, principals=principals)
+
+    def wrote_lately(self, principals):
+        """
+        Checks whether the client, by its cookie or the users it acts for, wrote within
+        the last REPLICA_STICKY_SECONDS
+        """
+        if request.cookies.get(STICKY_COOKIE, 0, type=float) > time.time():
+            return True
+        recent_writers = current_app.recent_writers
+        return recent_writers is not None and \
+            any(recent_writers.get(f'read_primary:{name}') is not None for name in principals)
+
+    def remember_writes(self, response):
+        """
+        Sends the reads of a client that just wrote to the primary for REPLICA_STICKY_SECONDS,
+        until the replicas have caught up with its write
+        """
+        if self.session.info.get('wrote') and current_app.config['DATABASE_REPLICAS']:
+            sticky = current_app.config['REPLICA_STICKY_SECONDS']
+            response.set_cookie(STICKY_COOKIE, str(time.time() + sticky), max_age=sticky,
+                                httponly=True, samesite='Lax')
+            if current_app.recent_writers is not None:
+                for name in self.session.info.get('principals', ()):
+                    current_app.recent_writers.set(f'read_primary:{name}', True, sticky)
+        return response
+
+    def end_routing(self, exc):
+        """
+        Sends whatever runs after the request, in the same application context, to the primary
+        """
+        self.session.info.pop('replica', None)
+
+    def create_engine(self, sa_url, engine_opts):
+        """
+        Creates an engine, making SQLite engines run their PRAGMAs on every new connection
+        """
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', lambda connection, record: set_pragmas(connection, pragmas))
+        return engine
+
+
+def set_pragmas(connection, pragmas):
+    """
+    Runs PRAGMA name = value on a new SQLite connection for every item of pragmas
+    """
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+def pool_stats(engine):
+    """
+    returns the size and use of an engine's connection pool
+    """
+    pool = engine.pool
+    stats = {'dialect': engine.dialect.name, 'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                     overflow=pool.overflow(), max_overflow=pool._max_overflow)
+    else:
+        stats['status'] = pool.status()
+    return stats
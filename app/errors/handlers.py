@@ -1,6 +1,8 @@
 from app import db
-from flask import render_template
+from flask import jsonify, make_response, render_template, request
 from app.errors import bp
+from app.passwords import HasherBusy
+from werkzeug.exceptions import ServiceUnavailable
 
 
 @bp.app_errorhandler(404)
@@ -19,3 +21,26 @@ def internal_error(error):
     # Ensure failed db session doesn't interfere with db access
     db.session.rollback()
     return render_template('errors/500.html'), 500
+
+
+@bp.app_errorhandler(429)
+@bp.app_errorhandler(503)
+def busy_error(error):
+    """
+    Function asks the client to come back later when it sends too many requests
+    or the server won't take on more work, Retry-After tells when
+    """
+    if request.path.startswith('/api/'):
+        response = make_response(jsonify({"error": error.description}), error.code)
+    else:
+        response = make_response(render_template('errors/busy.html', error=error), error.code)
+    response.headers.extend(header for header in error.get_headers() if header[0] == 'Retry-After')
+    return response
+
+
+@bp.app_errorhandler(HasherBusy)
+def hasher_busy_error(error):
+    """
+    Function turns a full password hasher into a 503
+    """
+    return busy_error(ServiceUnavailable("Too many logins at once, please retry shortly", retry_after=1))
@@ -0,0 +1,69 @@
+"""
+A module that exports the catalog, its users and their loans for the data warehouse
+Tables are streamed from a server-side cursor straight into gzipped files,
+so memory use doesn't depend on the size of the tables
+Incremental exports carry the books and users deleted since the watermark as
+tombstones in the deletions file, the loans are always exported in full
+"""
+import csv
+import gzip
+import json
+import os
+from datetime import datetime
+from app import db
+from app.models import Book, Deletion, User, user_book
+
+
+def export_tables():
+    """
+    returns the exported tables keyed by name, each with its columns and
+    the timestamp column incremental exports filter on (None to always export in full)
+    """
+    book, user, deletion = Book.__table__, User.__table__, Deletion.__table__
+    return {
+        'books': ([book.c.id, book.c.title, book.c.author, book.c.synopsis,
+                   book.c.year_of_publish, book.c.img_url, book.c.updated_at], book.c.updated_at),
+        # password hashes never leave the database
+        'users': ([user.c.id, user.c.name, user.c.email, user.c.is_admin, user.c.updated_at], user.c.updated_at),
+        'loans': ([user_book.c.user_id, user_book.c.book_id], None),
+        # tombstones, table_name is books' or users' table and row_id the deleted row's id
+        'deletions': ([deletion.c.table_name, deletion.c.row_id, deletion.c.deleted_at], deletion.c.deleted_at)
+    }
+
+
+def to_json(value):
+    """
+    Converts the values json can't serialize, timestamps are written in ISO 8601
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def export_table(name, directory, format='jsonl', since=None, batch_size=1000):
+    """
+    Writes the rows of an exported table to a gzipped file in directory
+    Only rows changed at or after since are written when the table has a timestamp
+    returns the path of the file and the number of rows written
+    """
+    columns, changed = export_tables()[name]
+    query = db.select(*columns).order_by(*columns[:2])
+    if since is not None and changed is not None:
+        query = query.where(changed >= since)
+
+    path = os.path.join(directory, f'{name}.{format}.gz')
+    count = 0
+    with db.engine.connect() as connection, gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(query)
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(column.name for column in columns)
+        for partition in result.partitions(batch_size):
+            for row in partition:
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    record = {column.name: value for column, value in zip(columns, row)}
+                    f.write(json.dumps(record, default=to_json) + '\n')
+            count += len(partition)
+    return path, count
@@ -0,0 +1,92 @@
+"""
+A module that resolves who is behind a request without querying the user table each time
+API tokens and web sessions are checked against the same per-user version stamp,
+the time the user's details last changed, which every worker reloads periodically
+"""
+import datetime
+import time
+import jwt
+from flask import current_app, request
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+from app.models import User, TokenRevocation
+
+
+def revocations():
+    """
+    Returns the time of the latest revocation of each user's tokens, keyed by user id
+    The list lives in the database so that every worker sees it, and each process
+    reads it again at most once every TOKEN_REVOCATION_REFRESH seconds
+    """
+    loaded_at, revoked = current_app.token_revocations
+    now = time.monotonic()
+    if now - loaded_at >= current_app.config['TOKEN_REVOCATION_REFRESH']:
+        # revocations older than a token's lifetime can't refuse any live token
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['TOKEN_LIFETIME'])
+        rows = db.session.query(TokenRevocation.user_id, TokenRevocation.revoked_at) \
+            .filter(TokenRevocation.revoked_at > since)
+        revoked = {user_id: revoked_at.replace(tzinfo=datetime.timezone.utc).timestamp() for user_id, revoked_at in rows}
+        current_app.token_revocations = (now, revoked)
+    return revoked
+
+
+def forget_user(user_id):
+    """
+    Revokes every token issued to a user so far and drops the user's cached identity,
+    on every worker, once the caller commits
+    Call it whenever a user's details change or the user is deleted. This worker
+    forgets them right away, the others within TOKEN_REVOCATION_REFRESH seconds
+    """
+    now = datetime.datetime.utcnow()
+    db.session.merge(TokenRevocation(user_id=user_id, revoked_at=now))
+    since = now - datetime.timedelta(seconds=current_app.config['TOKEN_LIFETIME'])
+    TokenRevocation.query.filter(TokenRevocation.revoked_at <= since).delete()
+    current_app.token_cache.evict(lambda cached: cached[0].id == user_id)
+    current_app.identity_cache.evict(lambda snapshot: snapshot['id'] == user_id)
+    loaded_at, revoked = current_app.token_revocations
+    revoked = dict(revoked)
+    revoked[user_id] = now.replace(tzinfo=datetime.timezone.utc).timestamp()
+    current_app.token_revocations = (loaded_at, revoked)
+
+
+def load_user(id):
+    """
+    The user loader of the web interface's sessions
+    Users are cached for IDENTITY_CACHE_TTL seconds under their id and version stamp,
+    and rebuilt from the cached column values without a query
+    returns the user, or None if no user has that id
+    """
+    user_id = int(id)
+    key = (user_id, revocations().get(user_id, 0))
+    snapshot = current_app.identity_cache.get(key)
+    if snapshot is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        snapshot = {attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs}
+        current_app.identity_cache.set(key, snapshot)
+        return user
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    # attach it to the session as it is, relationships still load on access
+    return db.session.merge(user, load=False)
+
+
+def request_principals():
+    """
+    returns the names of the users a request acts for, taken from its API token's claims or
+    its basic auth credentials, without checking them against the database
+    The names are only used to send the reads of clients that wrote lately to the primary
+    """
+    names = []
+    token = request.headers.get('x-access-token')
+    if token:
+        try:
+            claims = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms="HS256")
+        except jwt.InvalidTokenError:
+            claims = {}
+        if isinstance(claims.get('name'), str):
+            names.append(claims['name'])
+    if request.authorization and request.authorization.username:
+        names.append(request.authorization.username)
+    return names
@@ -0,0 +1,217 @@
+"""
+A module that turns uploaded book covers into the sizes shown across the app
+Each cover is stored once at full size plus one smaller copy per entry of
+COVER_SIZES, so pages only download the resolution they actually display
+Covers are named after a hash of their content, so the same cover is never stored twice
+and its files never change, letting browsers cache them for good
+"""
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from app import db
+from PIL import Image, ImageOps, features
+
+
+def cover_format():
+    """
+    Returns the PIL format and file extension resized covers are saved in
+    WebP is the most compact, progressive JPEG stands in when PIL lacks WebP support
+    """
+    if features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+
+def images_dir():
+    """
+    Returns the directory covers are stored in
+    """
+    return os.path.join(current_app.root_path, current_app.config['BOOK_IMAGES_DIR'])
+
+
+def open_cover(fp, max_pixels):
+    """
+    Opens a cover image, reading no more than its header
+    raises ValueError if the image has more than max_pixels pixels, before any of it is decoded
+    """
+    image = Image.open(fp)
+    if image.width * image.height > max_pixels:
+        image.close()
+        raise ValueError(f"image is larger than {max_pixels} pixels")
+    return image
+
+
+def store_cover(upload):
+    """
+    Stores an uploaded cover under a name derived from its content
+    The upload is hashed while it is copied to disk in chunks, then moved over any
+    stored copy of the same cover. That puts back a copy a pending delete_cover_files
+    removed, and marks the file as fresh so the ones still pending leave it alone
+    returns the file name, raises ValueError for images that are too large or of another format
+    """
+    image = open_cover(upload.stream, current_app.config['COVER_MAX_PIXELS'])
+    extensions = {'JPEG': 'jpg', 'PNG': 'png'}
+    if image.format not in extensions:
+        raise ValueError("image must be a JPEG or PNG file")
+    upload.stream.seek(0)
+
+    directory = images_dir()
+    digest = hashlib.sha256()
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            for chunk in iter(lambda: upload.stream.read(64 * 1024), b''):
+                digest.update(chunk)
+                f.write(chunk)
+        file_name = f'{digest.hexdigest()[:32]}.{extensions[image.format]}'
+        # same content, so readers of the stored copy see no difference
+        os.replace(temp_path, os.path.join(directory, file_name))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return file_name
+
+
+def resize_cover(directory, file_name, sizes, max_pixels, overwrite=False):
+    """
+    Saves a resized copy of a cover for every size, given as a name and a width
+    Copies that already exist are kept unless overwrite is set, their content can't differ
+    Runs without an application context so it can be handed to worker processes
+    returns the file names of the copies keyed by size name
+    """
+    format, extension = cover_format()
+    stem = os.path.splitext(file_name)[0]
+    names = {name: f'{stem}_{name}.{extension}' for name in sizes}
+    if not overwrite and all(os.path.exists(os.path.join(directory, name)) for name in names.values()):
+        return names
+    with open_cover(os.path.join(directory, file_name), max_pixels) as image:
+        # JPEGs are decoded straight at the smallest scale that still covers the largest copy
+        largest = max(sizes.values())
+        image.draft('RGB', (largest, largest))
+        # honour the camera's orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        if format == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        # produce the largest size first and shrink each copy from the previous one
+        for name, width in sorted(sizes.items(), key=lambda size: size[1], reverse=True):
+            if image.width > width:
+                image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            path = os.path.join(directory, names[name])
+            if format == 'WEBP':
+                image.save(path, format, quality=80, method=4)
+            else:
+                image.save(path, format, quality=80, optimize=True, progressive=True)
+    return names
+
+
+def record_thumbnails(book, names):
+    """
+    Records the file names of a cover's resized copies on its book
+    """
+    book.img_thumb = names.get('thumb')
+    book.img_card = names.get('card')
+    book.img_detail = names.get('detail')
+
+
+def make_thumbnails(book):
+    """
+    Creates the resized copies of a book's cover and records them on the book
+    """
+    names = resize_cover(images_dir(), book.img_url, current_app.config['COVER_SIZES'],
+                         current_app.config['COVER_MAX_PIXELS'])
+    record_thumbnails(book, names)
+
+
+def rebuild_thumbnails(workers=None, force=False, batch_size=100):
+    """
+    Creates the resized copies of every cover that lacks them, or of all covers if force is set
+    Covers are resized in parallel by a pool of worker processes, one batch of books at a time
+    returns the number of covers resized and a list of (book id, error) for those that failed
+    """
+    from app.models import Book
+    directory = images_dir()
+    sizes = current_app.config['COVER_SIZES']
+    max_pixels = current_app.config['COVER_MAX_PIXELS']
+    query = Book.query.filter(Book.img_url.isnot(None))
+    if not force:
+        query = query.filter(Book.img_thumb.is_(None))
+
+    done, failed = 0, []
+    last_id = 0
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            books = query.filter(Book.id > last_id).order_by(Book.id).limit(batch_size).all()
+            if not books:
+                break
+            last_id = books[-1].id
+            futures = [(book, pool.submit(resize_cover, directory, book.img_url, sizes, max_pixels, force)) for book in books]
+            for book, future in futures:
+                try:
+                    record_thumbnails(book, future.result())
+                    done += 1
+                except (OSError, ValueError) as e:
+                    failed.append((book.id, str(e)))
+            db.session.commit()
+    return done, failed
+
+
+def cover_files(book):
+    """
+    returns the names of every file stored for a book's cover
+    """
+    return [name for name in (book.img_url, book.img_thumb, book.img_card, book.img_detail) if name]
+
+
+def cover_stem(file_name):
+    """
+    returns the part of a cover file's name shared by the cover and its resized copies
+    """
+    stem = os.path.splitext(file_name)[0]
+    for size in current_app.config['COVER_SIZES']:
+        if stem.endswith(f'_{size}'):
+            return stem[:-len(size) - 1]
+    return stem
+
+
+def delete_cover_files(file_names):
+    """
+    Removes cover files from the file system, skipping any that are already gone
+    Files of a cover still used by another book, which uploaded the same cover, are kept,
+    and so are files written within COVER_DELETE_GRACE seconds: they may belong to a
+    book that deduplicated onto them and isn't committed yet
+    returns the file names kept for being recent, to be checked again later
+    """
+    from app.models import Book
+    columns = (Book.img_url, Book.img_thumb, Book.img_card, Book.img_detail)
+    file_names = set(file_names)
+    stems = {cover_stem(name) for name in file_names}
+    used = set()
+    if file_names:
+        # a cover's resized copies are in use as long as the cover is, even before
+        # the book using it records them
+        query = Book.query.with_entities(*columns).filter(db.or_(
+            *(column.in_(file_names) for column in columns),
+            *(Book.img_url.like(f'{stem}.%') for stem in stems)))
+        for row in query:
+            used.update(row)
+            if row[0]:
+                used.add(cover_stem(row[0]))
+    directory = images_dir()
+    fresh_after = time.time() - current_app.config['COVER_DELETE_GRACE']
+    kept = []
+    for file_name in file_names:
+        if file_name in used or cover_stem(file_name) in used:
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            if os.path.getmtime(path) > fresh_after:
+                kept.append(file_name)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    return kept
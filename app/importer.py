@@ -0,0 +1,176 @@
+"""
+A module that imports books into the catalog in bulk
+Input is streamed as CSV or JSON lines, validated in chunks and inserted
+batch by batch, each batch in its own transaction
+"""
+import csv
+import json
+from itertools import islice
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from app import db
+from app.models import Book, Counter
+from app.search import add_to_index
+
+
+# Columns an imported book may set and the longest value each accepts (None for integers)
+IMPORT_COLUMNS = {
+    'title': 500,
+    'synopsis': 1000,
+    'author': 50,
+    'year_of_publish': None,
+    'img_url': 40,
+    'copies_total': None
+}
+
+
+class ImportReport(object):
+    """
+    A class that collects the outcome of an import
+    """
+    # Stop recording row errors past this many, they are still counted
+    max_errors = 1000
+
+    def __init__(self):
+        self.inserted = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row, error):
+        """
+        Records that the row on a given line was rejected
+        """
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row, 'error': error})
+
+    def to_dict(self):
+        """
+        returns the report as a dictionary fit for a JSON response
+        """
+        return {'inserted': self.inserted, 'error_count': self.error_count, 'errors': self.errors}
+
+
+def read_rows(stream, format):
+    """
+    Reads the records of a text stream in the given format, csv or jsonl
+    yields (row number, record) pairs, the record is None for unparseable lines
+    """
+    if format == 'csv':
+        # the header is row 1
+        for number, record in enumerate(csv.DictReader(stream), start=2):
+            yield number, record
+    elif format == 'jsonl':
+        for number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+    else:
+        raise ValueError(f"Unsupported import format: {format}")
+
+
+def validate_book(record):
+    """
+    Checks an imported record and converts it into the values of a book row
+    returns the values, or raises ValueError describing what is wrong
+    """
+    if not isinstance(record, dict):
+        raise ValueError('row is not a valid record')
+    unknown = set(record) - set(IMPORT_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown column(s): {', '.join(sorted(str(column) for column in unknown))}")
+    values = {}
+    for column, max_length in IMPORT_COLUMNS.items():
+        value = record.get(column)
+        if value in (None, ''):
+            values[column] = None
+        elif max_length is None:
+            try:
+                values[column] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{column} must be an integer")
+            if values[column] < 0:
+                raise ValueError(f"{column} must not be negative")
+        else:
+            value = str(value).strip()
+            if len(value) > max_length:
+                raise ValueError(f"{column} is longer than {max_length} characters")
+            values[column] = value
+    for column in ('title', 'synopsis'):
+        if not values[column]:
+            raise ValueError(f"{column} is missing")
+    if values['copies_total'] is None:
+        values['copies_total'] = 1
+    # Core inserts bypass the model's validators, so set the lookup keys here
+    values['title_key'] = Book.normalize(values['title'])
+    values['author_key'] = Book.normalize(values['author'])
+    return values
+
+
+def insert_batch(rows):
+    """
+    Inserts the values of a batch of books in one transaction
+    The counters and the search index are updated here because Core inserts
+    don't go through the session events that maintain them
+    """
+    table = Book.__table__
+    if db.engine.dialect.name == 'postgresql':
+        inserted_ids = [id for (id,) in db.session.execute(table.insert().values(rows).returning(table.c.id))]
+    else:
+        # an executemany doesn't tell the ids it inserted, so rows go one at a time, still
+        # in one transaction, and each id is the cursor's lastrowid. Inferring them
+        # afterwards would also pick up books with the same titles added meanwhile
+        inserted_ids = [db.session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+    Counter.increment('book', len(rows))
+    Counter.increment('catalog_version', 1)
+    db.session.commit()
+
+    columns = [table.c[field] for field in Book.__searchable__]
+    inserted = db.session.query(table.c.id, *columns).filter(table.c.id.in_(inserted_ids)).all()
+    try:
+        add_to_index(Book.__tablename__, Book.__searchable__, inserted, replace=False)
+    except Exception:
+        current_app.logger.exception('Failed to index imported books')
+
+
+def import_books(stream, format, batch_size=None):
+    """
+    Imports the books of a text stream in the given format, csv or jsonl
+    Rows failing validation are reported and skipped, and a batch the database
+    rejects is retried row by row so that only the offending rows are lost
+    returns an ImportReport
+    """
+    if batch_size is None:
+        batch_size = current_app.config['BULK_IMPORT_BATCH_SIZE']
+    report = ImportReport()
+    rows = read_rows(stream, format)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        batch = []
+        for number, record in chunk:
+            try:
+                batch.append((number, validate_book(record)))
+            except ValueError as e:
+                report.add_error(number, str(e))
+        if not batch:
+            continue
+        try:
+            insert_batch([values for _, values in batch])
+            report.inserted += len(batch)
+        except SQLAlchemyError:
+            db.session.rollback()
+            for number, values in batch:
+                try:
+                    insert_batch([values])
+                    report.inserted += 1
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    # the driver's message may reveal the schema, it is only logged
+                    current_app.logger.warning(f'Import row {number} rejected by the database', exc_info=True)
+                    report.add_error(number, 'rejected by the database')
+    return report
@@ -0,0 +1,209 @@
+"""
+A module with a small durable job queue backed by the job table
+Slow work is enqueued in the same transaction as the request that causes it
+and run later by 'flask jobs worker', with retries surviving restarts
+"""
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import Job
+
+
+# Handlers of the known jobs, keyed by job name
+handlers = {}
+
+
+def job(name):
+    """
+    decorator function that registers a function as the handler of the jobs called name
+    """
+    def decorator(func):
+        handlers[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, **payload):
+    """
+    Adds a job to the session, it is queued once the caller commits
+    returns the job
+    """
+    if name not in handlers:
+        raise ValueError(f"Unknown job: {name}")
+    queued = Job(name=name, payload=json.dumps(payload))
+    db.session.add(queued)
+    return queued
+
+
+def claim_job():
+    """
+    Takes the next job that is due, marking it as running
+    The claim is a conditional update, so two workers never run the same job
+    returns the job, or None if no job is due
+    """
+    now = datetime.utcnow()
+    table = Job.__table__
+    while True:
+        job_id = db.session.query(Job.id).filter(Job.status == 'queued', Job.run_at <= now) \
+            .order_by(Job.run_at, Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        claimed = db.session.execute(table.update().where(table.c.id == job_id, table.c.status == 'queued').values(
+            status='running', attempts=table.c.attempts + 1, locked_at=now))
+        db.session.commit()
+        if claimed.rowcount == 1:
+            return Job.query.get(job_id)
+
+
+def heartbeat(app, job_id, stop):
+    """
+    Renews the lock of a running job every JOB_HEARTBEAT_INTERVAL seconds until stop is set,
+    so requeue_stale leaves it alone however long it runs
+    Runs on a thread of its own, with its own connection, beside the job's
+    """
+    table = Job.__table__
+    while not stop.wait(app.config['JOB_HEARTBEAT_INTERVAL']):
+        with app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.update().where(table.c.id == job_id, table.c.status == 'running')
+                                       .values(locked_at=datetime.utcnow()))
+            except Exception:
+                current_app.logger.exception(f'Heartbeat of job {job_id} failed')
+
+
+def run_job(claimed):
+    """
+    Runs a claimed job, deleting it if it succeeds
+    A job that fails is retried later with an exponential backoff until it
+    has used up JOB_MAX_ATTEMPTS, after which it is left as failed
+    """
+    stop = threading.Event()
+    beating = threading.Thread(target=heartbeat, daemon=True,
+                               args=(current_app._get_current_object(), claimed.id, stop))
+    beating.start()
+    try:
+        try:
+            handlers[claimed.name](**json.loads(claimed.payload))
+        finally:
+            stop.set()
+            beating.join()
+        db.session.delete(claimed)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception(f'Job {claimed.id} ({claimed.name}) failed')
+        claimed = Job.query.get(claimed.id)
+        claimed.last_error = repr(e)
+        claimed.locked_at = None
+        if claimed.attempts >= current_app.config['JOB_MAX_ATTEMPTS']:
+            claimed.status = 'failed'
+        else:
+            claimed.status = 'queued'
+            delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (claimed.attempts - 1)
+            claimed.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        db.session.commit()
+
+
+def requeue_stale():
+    """
+    Puts back in the queue the running jobs whose lock wasn't renewed for JOB_TIMEOUT
+    seconds, as happens when a worker dies in the middle of a job. Jobs that are still
+    running renew it every JOB_HEARTBEAT_INTERVAL seconds, however long they take
+    returns the number of jobs put back
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['JOB_TIMEOUT'])
+    table = Job.__table__
+    result = db.session.execute(table.update().where(table.c.status == 'running', table.c.locked_at < cutoff).values(
+        status='queued', locked_at=None))
+    db.session.commit()
+    return result.rowcount
+
+
+def work(threads=1, poll_interval=1.0, burst=False):
+    """
+    Runs due jobs on a pool of threads until interrupted
+    With burst set, returns as soon as no job is due instead of waiting for more
+    """
+    app = current_app._get_current_object()
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            with app.app_context():
+                claimed = claim_job()
+                if claimed is not None:
+                    run_job(claimed)
+                    continue
+            if burst:
+                return
+            stop.wait(poll_interval)
+
+    requeue_stale()
+    last_check = time.monotonic()
+    pool = [threading.Thread(target=loop, daemon=True) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in pool):
+            for thread in pool:
+                thread.join(poll_interval)
+            if time.monotonic() - last_check > app.config['JOB_TIMEOUT'] / 2:
+                with app.app_context():
+                    requeue_stale()
+                last_check = time.monotonic()
+    except KeyboardInterrupt:
+        # let the running jobs finish
+        stop.set()
+        for thread in pool:
+            thread.join()
+
+
+@job('process_cover')
+def process_cover(book_id):
+    """
+    Creates the resized copies of a book's cover
+    """
+    from app.images import make_thumbnails
+    from app.models import Book
+    book = Book.query.get(book_id)
+    if book is None or not book.img_url:
+        return
+    make_thumbnails(book)
+    db.session.commit()
+
+
+@job('delete_cover_files')
+def remove_cover_files(file_names):
+    """
+    Removes the files of a deleted book's cover
+    Files written too recently to be sure no book uses them are checked again later
+    """
+    from app.images import delete_cover_files
+    kept = delete_cover_files(file_names)
+    if kept:
+        retry = enqueue('delete_cover_files', file_names=kept)
+        retry.run_at = datetime.utcnow() + timedelta(seconds=current_app.config['COVER_DELETE_GRACE'])
+
+
+@job('overdue_reminder')
+def overdue_reminder(loan_id):
+    """
+    Reminds a borrower that their loan is past its due date
+    There is no mailer yet, so the reminder is logged
+    """
+    from app.models import Book, Loan, User
+    loan = Loan.query.get(loan_id)
+    if loan is None or loan.returned_at is not None or None in (loan.user_id, loan.book_id):
+        return
+    user = User.query.get(loan.user_id)
+    book = Book.query.get(loan.book_id)
+    # the user or the book was deleted since the reminder was queued
+    if user is None or book is None:
+        return
+    current_app.logger.warning(
+        f'Reminder: {user.name} <{user.email}> was due to return "{book.title}" on {loan.due_at:%Y-%m-%d}')
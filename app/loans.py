@@ -0,0 +1,56 @@
+"""
+A module with the batch work done over the loan ledger
+Scans walk the partial index on open loans by due date, so their cost follows
+the number of books currently out rather than the size of the loan history
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.jobs import enqueue
+from app.models import Loan
+
+
+def overdue_loans(now=None, batch_size=None):
+    """
+    Yields the open loans that were due before now and haven't been reminded within
+    OVERDUE_REMINDER_INTERVAL days, one batch of (due_at, id) rows at a time in due date order
+    Each batch starts after the (due_at, id) of the last loan of the previous one,
+    so no batch rereads the rows before it
+    """
+    now = now or datetime.utcnow()
+    batch_size = batch_size or current_app.config['OVERDUE_BATCH_SIZE']
+    reminded_before = now - timedelta(days=current_app.config['OVERDUE_REMINDER_INTERVAL'])
+    query = db.session.query(Loan.due_at, Loan.id) \
+        .filter(Loan.returned_at.is_(None), Loan.due_at < now) \
+        .filter(db.or_(Loan.reminded_at.is_(None), Loan.reminded_at < reminded_before)) \
+        .order_by(Loan.due_at, Loan.id)
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(db.tuple_(Loan.due_at, Loan.id) > last)
+        batch = page.limit(batch_size).all()
+        if not batch:
+            return
+        last = (batch[-1].due_at, batch[-1].id)
+        yield batch
+
+
+def remind_overdue(now=None, batch_size=None):
+    """
+    Queues an overdue_reminder job for every open loan that is past its due date
+    Loans are marked as reminded in the same transaction as their jobs, so running
+    the command again only reminds them once OVERDUE_REMINDER_INTERVAL days have passed
+    returns the number of reminders queued
+    """
+    now = now or datetime.utcnow()
+    loans = Loan.__table__
+    count = 0
+    for batch in overdue_loans(now, batch_size):
+        ids = [row.id for row in batch]
+        db.session.execute(loans.update().where(loans.c.id.in_(ids)).values(reminded_at=now))
+        for loan_id in ids:
+            enqueue('overdue_reminder', loan_id=loan_id)
+        db.session.commit()
+        count += len(ids)
+    return count
@@ -1,10 +1,16 @@
 """
 A module that handles the routes of the main part of the app
 """
-from flask import render_template
+from flask import current_app, redirect, render_template, request, url_for
 from flask_login import login_required
+from markupsafe import Markup
+from app import db
 from app.main import bp
-from app.models import Book, User
+from app.models import Book, Counter, User
+from app.api.v1.pagination import keyset_page
+
+# The columns the book grid shows, full rows would also drag the synopsis along
+GRID_COLUMNS = (Book.id, Book.title, Book.img_url, Book.img_thumb, Book.img_card, Book.img_detail)
 
 
 @bp.route('/')
@@ -12,7 +18,50 @@ from app.models import Book, User
 @login_required
 def index():
     """
-    Route returns the home page of the application
+    Route returns the home page of the application, a page of books at a time
+    Pages follow the book ids, the after parameter holds the last id of the previous page
+    """
+    after = request.args.get('after', type=int)
+    return render_template('main/index.html', title="Home", grid=book_grid(after))
+
+
+def book_grid(after):
+    """
+    Renders the grid of a page of the home page
+    Grids are kept in the response cache under the catalog version, so any write to the
+    books retires them, and a page costs a counter read however large the catalog is
+    returns the grid's HTML
+    """
+    per_page = current_app.config['BOOKS_PER_PAGE']
+    cache = current_app.response_cache
+    if cache is not None:
+        version, _ = Counter.catalog_version()
+        key = repr((request.endpoint, version, per_page, after))
+        grid = cache.get(key)
+        if grid is not None:
+            return Markup(grid)
+    books, next_cursor = keyset_page(db.session.query(*GRID_COLUMNS), Book.id, per_page, after)
+    grid = render_template('main/_grid.html', books=books,
+                           first_url=url_for('main.index') if after is not None else None,
+                           next_url=url_for('main.index', after=next_cursor) if next_cursor is not None else None)
+    if cache is not None:
+        cache.set(key, grid)
+    return Markup(grid)
+
+
+@bp.route('/search')
+@login_required
+def search():
+    """
+    Route returns the books matching a search, best match first
     """
-    books = Book.query.all()
-    return render_template('main/index.html', title="Home", books=books)
+    q = request.args.get('q', '').strip()
+    if not q:
+        return redirect(url_for('main.index'))
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['BOOKS_PER_PAGE']
+    books, total = Book.search(q, page, per_page)
+    next_url = url_for('main.search', q=q, page=page + 1) if total > page * per_page else None
+    prev_url = url_for('main.search', q=q, page=page - 1) if page > 1 else None
+    grid = render_template('main/_grid.html', books=books.all(), q=q, next_url=next_url, prev_url=prev_url)
+    return render_template('main/index.html', title="Search", grid=Markup(grid), q=q)
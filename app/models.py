@@ -1,18 +1,208 @@
 """
 A module with classes serving as database tables
 """
-from app import db, login
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from flask import current_app
+from app import db
+from app.search import add_to_index, remove_from_index, query_index
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import validates
+
+
+class SearchableMixin(object):
+    """
+    A mixin that keeps a model's full-text search index in step with the database
+    Models list the columns to index, most important first, in __searchable__
+    """
+    @classmethod
+    def search(cls, expression, page, per_page):
+        """
+        Searches the model's index for expression
+        returns a query yielding the models on the requested page, best match first, and the total number of hits
+        """
+        ids, total = query_index(cls.__tablename__, cls.__searchable__, expression, page, per_page)
+        if not ids:
+            return cls.query.filter(db.false()), total
+        # preserve the ranking of the search index
+        return cls.query.filter(cls.id.in_(ids)).order_by(db.case({id: position for position, id in enumerate(ids)}, value=cls.id)), total
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Records the searchable models that were added, changed or removed in the flush
+        The index is only updated once the transaction commits
+        """
+        changes = session.info.setdefault('search_changes', {})
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, SearchableMixin) and any(
+                    db.inspect(obj).attrs[field].history.has_changes() for field in obj.__searchable__):
+                # keep a snapshot, the object itself is expired by the commit
+                values = {field: getattr(obj, field) for field in obj.__searchable__}
+                changes[(type(obj), obj.id)] = SimpleNamespace(id=obj.id, **values)
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes[(type(obj), obj.id)] = None
+
+    @classmethod
+    def after_commit(cls, session):
+        """
+        Applies the changes recorded during the transaction to the search indexes
+        """
+        changes = session.info.pop('search_changes', None)
+        if not changes:
+            return
+        try:
+            for (model, id), document in changes.items():
+                if document is None:
+                    remove_from_index(model.__tablename__, model.__searchable__, [id])
+                else:
+                    add_to_index(model.__tablename__, model.__searchable__, [document])
+        except Exception:
+            # the data is already committed, a stale index is repaired with 'flask search reindex'
+            current_app.logger.exception('Failed to update the search index')
+
+    @classmethod
+    def after_rollback(cls, session):
+        """
+        Discards the changes recorded during a transaction that was rolled back
+        """
+        session.info.pop('search_changes', None)
+
+    @classmethod
+    def reindex(cls):
+        """
+        Rebuilds the model's index from every row in the database
+        Rows are read as plain tuples in batches so memory stays flat
+        """
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        query = db.session.query(cls.id, *columns).order_by(cls.id).yield_per(1000)
+        batch = []
+        for row in query:
+            batch.append(row)
+            if len(batch) == 1000:
+                add_to_index(cls.__tablename__, cls.__searchable__, batch)
+                batch = []
+        if batch:
+            add_to_index(cls.__tablename__, cls.__searchable__, batch)
+
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
+db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 # An association table with a record of students who've borrowed a book(s)
+# A user holds a book at most once, the pair is the table's primary key
 user_book = db.Table('user_book',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('book_id', db.Integer, db.ForeignKey('book.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('book_id', db.Integer, db.ForeignKey('book.id'), primary_key=True)
 )
 
 
+class BookUnavailable(Exception):
+    """
+    Raised when every copy of a book is already on loan
+    """
+
+
+def borrow(user_id, book_id):
+    """
+    Records that a user borrowed a book, opens a loan in the ledger and takes one of its
+    copies off the shelf without loading either of them, in two INSERTs and one conditional UPDATE
+    Borrowing a book twice, or a book that doesn't exist, changes nothing
+    returns whether a loan was recorded, the caller commits
+    raises BookUnavailable if no copy is left
+    """
+    select = db.select(db.literal(user_id), Book.id).where(Book.id == book_id)
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(db.engine.dialect.name)
+    if dialect is not None:
+        insert = dialect.insert(user_book).on_conflict_do_nothing()
+        result = db.session.execute(insert.from_select(['user_id', 'book_id'], select))
+    else:
+        try:
+            with db.session.begin_nested():
+                result = db.session.execute(user_book.insert().from_select(['user_id', 'book_id'], select))
+        except IntegrityError:
+            return False
+    if result.rowcount == 0:
+        return False
+    now = datetime.utcnow()
+    loans = Loan.__table__
+    db.session.execute(loans.insert().values(
+        user_id=user_id, book_id=book_id, borrowed_at=now,
+        due_at=now + timedelta(days=current_app.config['LOAN_PERIOD_DAYS'])))
+    # The copy is taken last so the book's row stays locked for as little time as possible
+    # Concurrent checkouts queue on that row lock, and the WHERE clause is checked again
+    # once the lock is granted, so copies_available can never drop below zero
+    books = Book.__table__
+    taken = db.session.execute(
+        books.update()
+        .where(books.c.id == book_id, books.c.copies_available > 0)
+        .values(copies_available=books.c.copies_available - 1))
+    if taken.rowcount == 0:
+        db.session.execute(
+            user_book.delete().where(user_book.c.user_id == user_id, user_book.c.book_id == book_id))
+        db.session.execute(loans.delete().where(
+            loans.c.user_id == user_id, loans.c.book_id == book_id, loans.c.returned_at.is_(None)))
+        raise BookUnavailable("no copies of this book are available")
+    return True
+
+
+def give_back(user_id, book_id):
+    """
+    Records that a user returned a book, closes its loan and puts the copy back on the shelf
+    returns whether the user was holding the book, the caller commits
+    """
+    result = db.session.execute(
+        user_book.delete().where(user_book.c.user_id == user_id, user_book.c.book_id == book_id))
+    if result.rowcount == 0:
+        return False
+    loans = Loan.__table__
+    db.session.execute(loans.update().where(
+        loans.c.user_id == user_id, loans.c.book_id == book_id, loans.c.returned_at.is_(None)
+    ).values(returned_at=datetime.utcnow()))
+    books = Book.__table__
+    db.session.execute(
+        books.update()
+        .where(books.c.id == book_id, books.c.copies_available < books.c.copies_total)
+        .values(copies_available=books.c.copies_available + 1))
+    return True
+
+
+def give_back_all(session, flush_context, instances):
+    """
+    Returns the books held by users about to be deleted, before the ORM drops
+    their user_book rows, so none of their copies stay off the shelf for good
+    The loans of deleted users and books are closed and kept in the ledger, detached
+    from the row that is going away, the same on every database whether or not it
+    enforces the foreign keys' ON DELETE SET NULL
+    """
+    user_ids = [obj.id for obj in session.deleted if isinstance(obj, User)]
+    book_ids = [obj.id for obj in session.deleted if isinstance(obj, Book)]
+    if not user_ids and not book_ids:
+        return
+    books, loans = Book.__table__, Loan.__table__
+    now = datetime.utcnow()
+    if user_ids:
+        held = user_book.c.user_id.in_(user_ids)
+        returned = db.select(db.func.count()).where(held, user_book.c.book_id == books.c.id).scalar_subquery()
+        session.execute(
+            books.update()
+            .where(books.c.id.in_(db.select(user_book.c.book_id).where(held)))
+            .values(copies_available=books.c.copies_available + returned))
+        session.execute(loans.update().where(loans.c.user_id.in_(user_ids)).values(
+            user_id=None, returned_at=db.func.coalesce(loans.c.returned_at, now)))
+    if book_ids:
+        session.execute(loans.update().where(loans.c.book_id.in_(book_ids)).values(
+            book_id=None, returned_at=db.func.coalesce(loans.c.returned_at, now)))
+
+
+db.event.listen(db.session, 'before_flush', give_back_all)
+
+
 class User(UserMixin, db.Model):
     """
     A class that represents the user table in the database
@@ -22,8 +212,12 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(32), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
     is_admin = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
     # Attach a record of books borrowed by a user
-    borrowed_books = db.relationship('Book', secondary=user_book, backref="borrowers")
+    # Neither side loads on access, queries that need them say how with selectinload or
+    # contains_eager, or use the helpers below, so no page runs a query per book or user
+    borrowed_books = db.relationship('Book', secondary=user_book, lazy='raise',
+                                     backref=db.backref('borrowers', lazy='raise'))
 
     @property
     def password(self):
@@ -36,15 +230,37 @@ class User(UserMixin, db.Model):
         """
         A method that generates a password hash from users' passwords
         Takes a password as an arguement and sets the hashed password as the password hash
+        The hashing runs in the password hasher's pool, see app.passwords
         """
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.generate(password)
 
     def check_password(self, password):
         """
         A method that confirms confirms a hash is assigned to the correct password
         return True if the hash matches the password and flase if it doesn't
+        A matching password whose hash was made with an older method or cost is hashed
+        again with the current one, the caller commits
+        """
+        hasher = current_app.password_hasher
+        if not hasher.check(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.password_hash = hasher.generate(password)
+        return True
+
+    def loan_count(self):
+        """
+        returns the number of books the user is holding, counted on the user_book primary key
+        """
+        return db.session.query(db.func.count()).select_from(user_book) \
+            .filter(user_book.c.user_id == self.id).scalar()
+
+    def has_borrowed(self, book_id):
         """
-        return check_password_hash(self.password_hash, password)
+        Checks whether the user is holding a book
+        """
+        return db.session.query(user_book.c.book_id) \
+            .filter(user_book.c.user_id == self.id, user_book.c.book_id == book_id).first() is not None
 
     def __repr__(self):
         """
@@ -53,28 +269,297 @@ class User(UserMixin, db.Model):
         return f"<User_id: {self.id}, User_name: {self.name}>"
 
 
-@login.user_loader
-def load_user(id):
-    """
-    A user loader function that aids flask in geting user id for login
-    returns the user id
-    """
-    return User.query.get(int(id))
-
-
-class Book(db.Model):
+class Book(SearchableMixin, db.Model):
     """
     A class that represents book table in the database
     """
+    __searchable__ = ['title', 'author', 'synopsis']
     id = db.Column(db.Integer, index=True, primary_key=True)
     synopsis = db.Column(db.String(1000), nullable=False)
     title = db.Column(db.String(500), nullable=False)
     author = db.Column(db.String(50))
     year_of_publish = db.Column(db.Integer)
     img_url = db.Column(db.String(40))
+    # Resized copies of the cover, see app.images
+    img_thumb = db.Column(db.String(64))
+    img_card = db.Column(db.String(64))
+    img_detail = db.Column(db.String(64))
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Casefolded copies of the title and author, kept in step by the validators below
+    # Lookups go through these so they are both indexed and case-insensitive
+    # Casefolding turns a character into up to three ("ΐ"), hence three times the width
+    title_key = db.Column(db.String(1500), index=True)
+    author_key = db.Column(db.String(150), index=True)
+    # Copies the library owns and how many of them are on the shelf
+    # copies_available only changes through the conditional UPDATEs in borrow and give_back
+    copies_total = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    copies_available = db.Column(db.Integer, nullable=False, server_default='1',
+                                 default=lambda context: context.get_current_parameters()['copies_total'])
+    __table_args__ = (
+        db.CheckConstraint('copies_available >= 0 AND copies_available <= copies_total', name='ck_book_copies'),
+        # the admin dashboard's sort orders, ties broken by id
+        db.Index('ix_book_title_key_id', 'title_key', 'id'),
+        db.Index('ix_book_author_key_id', 'author_key', 'id'),
+        db.Index('ix_book_year_of_publish_id', 'year_of_publish', 'id'),
+        db.Index('ix_book_updated_at_id', 'updated_at', 'id'),
+    )
+
+    @staticmethod
+    def normalize(value):
+        """
+        Returns the lookup key for a title or author name
+        """
+        if value is None:
+            return None
+        return value.strip().casefold()
+
+    @validates('title')
+    def validate_title(self, key, title):
+        """
+        Keeps the title's lookup key up to date whenever the title is set
+        """
+        self.title_key = Book.normalize(title)
+        return title
+
+    @validates('author')
+    def validate_author(self, key, author):
+        """
+        Keeps the author's lookup key up to date whenever the author is set
+        """
+        self.author_key = Book.normalize(author)
+        return author
+
+    def set_copies_total(self, total):
+        """
+        Changes the number of copies the library owns, copies on loan stay on loan
+        raises ValueError if that leaves fewer copies than are currently lent out
+        """
+        if total < self.copies_total - self.copies_available:
+            raise ValueError("copies_total is lower than the number of copies on loan")
+        # computed by the database, so loans made meanwhile are not lost
+        self.copies_available = Book.copies_available + (total - Book.copies_total)
+        self.copies_total = total
 
     def __repr__(self):
         """
         Returns a string representation of a book object
         """
         return f"<Book_id: {self.id}, Book_title: {self.title} by {self.author}>"
+
+
+class Counter(db.Model):
+    """
+    A class that represents the counter table in the database
+    Each row holds the running number of rows of another table so that
+    totals are read in constant time instead of counting the whole table
+    The catalog_version row instead counts every write made to the books
+    """
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # The tables whose rows are counted, keyed by counter name
+    counted = {'book': Book, 'user': User}
+
+    @classmethod
+    def increment(cls, name, delta, connection=None):
+        """
+        Adds delta to a counter in a single atomic statement
+        Runs on the session's connection unless another connection is given
+        """
+        if connection is None:
+            connection = db.session.connection()
+        connection.execute(cls.__table__.update().where(cls.name == name).values(
+            value=cls.value + delta, updated_at=datetime.utcnow()))
+
+    @classmethod
+    def catalog_version(cls):
+        """
+        Returns the version of the book catalog and the time it last changed
+        The version is bumped by every flush that adds, changes or removes a book
+        """
+        counter = cls.query.get('catalog_version')
+        if counter is None:
+            counter = cls(name='catalog_version', value=1, updated_at=datetime.utcnow())
+            db.session.add(counter)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # another worker created it first
+                db.session.rollback()
+                counter = cls.query.get('catalog_version')
+        return counter.value, counter.updated_at
+
+    @classmethod
+    def value_of(cls, name):
+        """
+        Returns the value of a counter, reconciling it first if it doesn't exist yet
+        """
+        counter = cls.query.get(name)
+        if counter is None:
+            try:
+                return cls.reconcile()[name]
+            except IntegrityError:
+                # another worker created the counter first
+                db.session.rollback()
+                counter = cls.query.get(name)
+        return counter.value
+
+    @classmethod
+    def reconcile(cls):
+        """
+        Recounts every counted table and corrects any counter that drifted
+        Each counter is set from a count taken by the UPDATE itself, so rows added
+        meanwhile, and the increments of their flushes, are never overwritten
+        returns the corrected values keyed by counter name
+        """
+        counters = cls.__table__
+        dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(db.engine.dialect.name)
+        present = {name for name, in db.session.query(cls.name).filter(cls.name.in_(cls.counted))}
+        for name, model in cls.counted.items():
+            if name not in present:
+                if dialect is not None:
+                    insert = dialect.insert(counters).on_conflict_do_nothing()
+                else:
+                    insert = counters.insert()
+                db.session.execute(insert.values(name=name, value=0, updated_at=datetime.utcnow()))
+            count = db.select(db.func.count()).select_from(model.__table__).scalar_subquery()
+            db.session.execute(counters.update().where(counters.c.name == name).values(
+                value=count, updated_at=datetime.utcnow()))
+        values = dict(db.session.query(cls.name, cls.value).filter(cls.name.in_(cls.counted)))
+        db.session.commit()
+        return values
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Applies the rows added and deleted by a flush to the counters
+        The update joins the flush's transaction, so counts can't drift from the data
+        """
+        for name, model in cls.counted.items():
+            delta = sum(isinstance(obj, model) for obj in session.new) - \
+                sum(isinstance(obj, model) for obj in session.deleted)
+            if delta:
+                cls.increment(name, delta, session.connection())
+        catalog_changed = any(isinstance(obj, Book) for obj in session.new) or \
+            any(isinstance(obj, Book) for obj in session.deleted) or \
+            any(isinstance(obj, Book) and session.is_modified(obj, include_collections=False) for obj in session.dirty)
+        if catalog_changed:
+            cls.increment('catalog_version', 1, session.connection())
+
+    def __repr__(self):
+        """
+        Returns a string representation of a counter object
+        """
+        return f"<Counter_name: {self.name}, Counter_value: {self.value}>"
+
+
+db.event.listen(db.session, 'after_flush', Counter.after_flush)
+
+
+class Loan(db.Model):
+    """
+    A class that represents the loan table in the database
+    Each row is one borrowing of a book, kept after the book is returned
+    user_book holds who has which book right now, this table holds the history
+    """
+    __table_args__ = (
+        # open loans by due date, the only rows overdue scans read
+        db.Index('ix_loan_open_due_at', 'due_at', 'id',
+                 sqlite_where=db.text('returned_at IS NULL'), postgresql_where=db.text('returned_at IS NULL')),
+        db.Index('ix_loan_user_id_borrowed_at', 'user_id', 'borrowed_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # NULL once the user or the book is deleted, the loan itself stays in the history
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'))
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id', ondelete='SET NULL'))
+    borrowed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    due_at = db.Column(db.DateTime, nullable=False)
+    returned_at = db.Column(db.DateTime)
+    reminded_at = db.Column(db.DateTime)
+    # loaded with the loans by current_loans, never on access
+    book = db.relationship('Book', lazy='raise')
+
+    def __repr__(self):
+        """
+        Returns a string representation of a loan object
+        """
+        return f"<Loan_id: {self.id}, User_id: {self.user_id}, Book_id: {self.book_id}, Due_at: {self.due_at}>"
+
+
+def current_loans(user_id):
+    """
+    returns the open loans of a user, oldest first, with their books loaded by the same query
+    """
+    return Loan.query.join(Loan.book).options(db.contains_eager(Loan.book)) \
+        .filter(Loan.user_id == user_id, Loan.returned_at.is_(None)) \
+        .order_by(Loan.borrowed_at, Loan.id).all()
+
+
+class TokenRevocation(db.Model):
+    """
+    A class that represents the token_revocation table in the database
+    API tokens of a user issued at or before revoked_at are refused by every worker
+    see app.api.v1.routes.users
+    """
+    user_id = db.Column(db.Integer, primary_key=True)
+    revoked_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class Deletion(db.Model):
+    """
+    A class that represents the deletion table in the database
+    Each row records that a book or a user was deleted, so incremental exports
+    can tell their consumers which rows to drop, see app.exporter
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(32), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        """
+        Records the books and users deleted by a flush, in the flush's transaction
+        Bulk deletes made with Query.delete don't go through here
+        """
+        now = datetime.utcnow()
+        rows = [{'table_name': obj.__tablename__, 'row_id': obj.id, 'deleted_at': now}
+                for obj in session.deleted if isinstance(obj, (Book, User))]
+        if rows:
+            session.connection().execute(cls.__table__.insert(), rows)
+
+    def __repr__(self):
+        """
+        Returns a string representation of a deletion object
+        """
+        return f"<Deletion_table: {self.table_name}, Deletion_row_id: {self.row_id}>"
+
+
+db.event.listen(db.session, 'after_flush', Deletion.after_flush)
+
+
+class Job(db.Model):
+    """
+    A class that represents the job table in the database
+    Each row is a unit of background work waiting for, or being run by, a worker
+    see app.jobs
+    """
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    # keyword arguments of the job's handler, encoded as JSON
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    # one of queued, running or failed, jobs are deleted once they succeed
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        """
+        Returns a string representation of a job object
+        """
+        return f"<Job_id: {self.id}, Job_name: {self.name}, Job_status: {self.status}>"
@@ -0,0 +1,72 @@
+"""
+A module that hashes and checks passwords away from the request threads
+Key stretching is deliberately slow CPU work, run on the request thread it
+starves every other request on the worker during a login storm, so it goes
+to a small process pool that accepts a bounded number of waiting passwords
+"""
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """
+    Raised when the password hasher already has as many passwords waiting as it accepts
+    """
+
+
+class PasswordHasher(object):
+    """
+    Hashes and checks passwords with the method and pool size read from the config
+    With PASSWORD_HASH_WORKERS set to 0 the work runs inline on the calling thread
+    """
+    def __init__(self, config):
+        self.method = config['PASSWORD_HASH_METHOD']
+        self.workers = config['PASSWORD_HASH_WORKERS']
+        self.pool = None
+        self.lock = threading.Lock()
+        # every worker busy plus PASSWORD_HASH_QUEUE passwords waiting for one
+        self.slots = threading.BoundedSemaphore(self.workers + config['PASSWORD_HASH_QUEUE'])
+
+    def run(self, func, *args):
+        """
+        Runs func in the pool and waits for its result
+        raises HasherBusy rather than queueing work beyond the limit
+        """
+        if not self.workers:
+            return func(*args)
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy("too many passwords are waiting to be checked")
+        try:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(self.workers)
+            return self.pool.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def generate(self, password):
+        """
+        returns the hash of a password, made with the configured method
+        """
+        return self.run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        """
+        returns True if the password matches the hash, whatever method made the hash
+        """
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        Checks whether a hash was made with another method or cost than the configured one
+        """
+        return pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        """
+        Stops the worker processes, if any were started
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -0,0 +1,258 @@
+"""
+A module with the token-bucket rate limiter guarding the expensive endpoints
+Every client IP and every username gets a bucket per scope, each request takes
+a token from it and tokens flow back at a steady rate. A request finding a bucket
+empty, or the server already running RATELIMIT_MAX_IN_FLIGHT guarded requests,
+is turned away at once instead of queueing for a worker
+Clients are told apart by the address the TRUSTED_PROXIES in front of the app
+forwarded, see create_app
+"""
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import current_app, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+
+def parse_rate(rate):
+    """
+    Reads a limit written as 'requests/seconds', e.g. '10/60'
+    returns the bucket's capacity and the tokens it regains per second
+    """
+    count, seconds = rate.split('/')
+    return int(count), int(count) / float(seconds)
+
+
+def refill(tokens, updated, capacity, per_second, now):
+    """
+    Takes a token from a bucket that last held tokens at updated
+    returns the tokens left, or the negative shortfall when the bucket is empty
+    """
+    return min(capacity, tokens + (now - updated) * per_second) - 1
+
+
+class MemoryBucketStore(object):
+    """
+    Token buckets kept in the memory of the worker process
+    Buckets that have filled up again are dropped once there are more than maxsize
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def take(self, key, capacity, per_second):
+        """
+        Takes a token from the bucket under key
+        returns the seconds to wait before retrying, 0 if the token was granted
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            left = refill(tokens, updated, capacity, per_second, now)
+            if left < 0:
+                return -left / per_second
+            # remember when the bucket is full again, it can be forgotten from then on
+            self.buckets[key] = (left, now, now + (capacity - left) / per_second)
+            if len(self.buckets) > self.maxsize:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+            return 0
+
+    def enter(self, limit, timeout):
+        """
+        Counts a request in, unless limit requests of this process are running already
+        returns a slot to hand back to leave, or None if the request is turned away
+        """
+        with self.lock:
+            if self.in_flight >= limit:
+                return None
+            self.in_flight += 1
+            return True
+
+    def leave(self, slot):
+        """
+        Counts a request out
+        """
+        with self.lock:
+            self.in_flight -= 1
+
+    def clear(self):
+        """
+        Drops every bucket
+        """
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteBucketStore(object):
+    """
+    Token buckets stored in a local SQLite file
+    Every worker process opening the same file shares the buckets and the count of
+    requests in flight, so the limits hold for the whole server rather than for each
+    gunicorn worker
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS in_flight (id INTEGER PRIMARY KEY, started REAL)')
+
+    def _connect(self):
+        """
+        returns the connection of the calling thread, opening it on first use
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, per_second):
+        """
+        Takes a token from the bucket under key
+        The bucket is read and written in one immediate transaction, so two
+        workers never both spend the last token
+        returns the seconds to wait before retrying, 0 if the token was granted
+        """
+        # wall clock time, monotonic clocks aren't shared between processes
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (capacity, now)
+            left = refill(tokens, updated, capacity, per_second, now)
+            if left >= 0:
+                connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                                   (key, left, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return 0 if left >= 0 else -left / per_second
+
+    def enter(self, limit, timeout):
+        """
+        Counts a request in, unless limit requests of any worker are running already
+        Requests that started more than timeout seconds ago are no longer counted, their
+        worker was killed before it could count them out
+        returns a slot to hand back to leave, or None if the request is turned away
+        """
+        now = time.time()
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM in_flight WHERE started < ?', (now - timeout,))
+            running = connection.execute('SELECT count(*) FROM in_flight').fetchone()[0]
+            slot = None
+            if running < limit:
+                slot = connection.execute('INSERT INTO in_flight (started) VALUES (?)', (now,)).lastrowid
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return slot
+
+    def leave(self, slot):
+        """
+        Counts a request out
+        """
+        self._connect().execute('DELETE FROM in_flight WHERE id = ?', (slot,))
+
+    def clear(self):
+        """
+        Drops every bucket and forgets the requests in flight
+        """
+        connection = self._connect()
+        connection.execute('DELETE FROM bucket')
+        connection.execute('DELETE FROM in_flight')
+
+
+class RateLimiter(object):
+    """
+    Applies the RATELIMIT_* settings of an application
+    """
+    def __init__(self, config):
+        self.enabled = config['RATELIMIT_ENABLED']
+        self.limits = {scope: parse_rate(config[f'RATELIMIT_{scope.upper()}']) for scope in ('auth', 'write')}
+        if config['RATELIMIT_STORAGE'] == 'sqlite':
+            self.store = SQLiteBucketStore(config['RATELIMIT_SQLITE_PATH'])
+        elif config['RATELIMIT_STORAGE'] == 'memory':
+            self.store = MemoryBucketStore()
+        else:
+            raise ValueError(f"Unknown rate limit storage: {config['RATELIMIT_STORAGE']}")
+        self.max_in_flight = config['RATELIMIT_MAX_IN_FLIGHT']
+        self.in_flight_timeout = config['RATELIMIT_IN_FLIGHT_TIMEOUT']
+
+    def check(self, scope, keys):
+        """
+        Takes a token from the bucket of every key in the scope
+        raises TooManyRequests, telling how long to wait, if any bucket is empty
+        """
+        capacity, per_second = self.limits[scope]
+        for key in keys:
+            wait = self.store.take(f'{scope}:{key}', capacity, per_second)
+            if wait:
+                raise TooManyRequests(retry_after=math.ceil(wait))
+
+    def enter(self):
+        """
+        Counts a request in against RATELIMIT_MAX_IN_FLIGHT
+        returns the slot to hand back to leave, None when there is no cap
+        raises ServiceUnavailable if the cap is reached
+        """
+        if not self.max_in_flight:
+            return None
+        slot = self.store.enter(self.max_in_flight, self.in_flight_timeout)
+        if slot is None:
+            raise ServiceUnavailable(retry_after=1)
+        return slot
+
+    def leave(self, slot):
+        """
+        Counts a request out
+        """
+        if slot is not None:
+            self.store.leave(slot)
+
+
+def current_username():
+    """
+    returns the name of the user logged in to the web app, if any
+    """
+    from flask_login import current_user
+    return None if current_user.is_anonymous else current_user.name
+
+
+def rate_limited(scope, username=None, methods=('POST', 'PUT', 'DELETE')):
+    """
+    decorator function that rate limits a route per client IP and, when username
+    returns one for the request, per username as well
+    Only requests with one of the given methods are limited, by default GET
+    requests, which just render forms, pass through
+    scope is 'auth' for password checks and sign ups, 'write' for admin writes
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            limiter = current_app.rate_limiter
+            if not limiter.enabled or request.method not in methods:
+                return func(*args, **kwargs)
+            keys = [f'ip:{request.remote_addr}']
+            name = username() if username is not None else None
+            if name:
+                keys.append(f'user:{name.strip().casefold()}')
+            limiter.check(scope, keys)
+            slot = limiter.enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                limiter.leave(slot)
+        return wrapped
+    return decorator
@@ -0,0 +1,74 @@
+"""
+A module that maintains the full-text search indexes of the application
+Indexes are stored on disk under WHOOSH_BASE and kept up to date incrementally
+as models are added, changed or removed, see SearchableMixin in app.models
+"""
+import os
+import threading
+from flask import current_app
+from whoosh import index
+from whoosh.fields import Schema, ID, TEXT
+from whoosh.qparser import MultifieldParser
+from whoosh.writing import AsyncWriter
+
+
+# Opened indexes, keyed by their directory, shared by the threads of a worker
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(name, fields):
+    """
+    Opens the index called name, creating it with a schema for fields if it doesn't exist
+    """
+    path = os.path.join(current_app.config['WHOOSH_BASE'], name)
+    with _lock:
+        if path not in _indexes:
+            if index.exists_in(path):
+                _indexes[path] = index.open_dir(path)
+            else:
+                os.makedirs(path, exist_ok=True)
+                schema = Schema(id=ID(stored=True, unique=True), **{field: TEXT for field in fields})
+                _indexes[path] = index.create_in(path, schema)
+        return _indexes[path]
+
+
+def add_to_index(name, fields, documents, replace=True):
+    """
+    Adds documents to the index called name, replacing any previous version of them
+    Documents are models or rows with an id and an attribute for each field
+    Pass replace=False for documents known to be new, which skips the costly lookup of old versions
+    """
+    # an AsyncWriter waits for the lock in a thread if another worker is writing
+    writer = AsyncWriter(get_index(name, fields))
+    write = writer.update_document if replace else writer.add_document
+    for document in documents:
+        write(id=str(document.id), **{field: str(getattr(document, field) or '') for field in fields})
+    writer.commit()
+
+
+def remove_from_index(name, fields, ids):
+    """
+    Removes the documents of the models with the given ids from the index called name
+    """
+    writer = AsyncWriter(get_index(name, fields))
+    for id in ids:
+        writer.delete_by_term('id', str(id))
+    writer.commit()
+
+
+def query_index(name, fields, expression, page, per_page):
+    """
+    Searches the index called name for expression across fields
+    Earlier fields are weighted more heavily when results are ranked
+    returns the ids of the models on the requested page, best match first, and the total number of hits
+    """
+    ix = get_index(name, fields)
+    boosts = {field: len(fields) - position for position, field in enumerate(fields)}
+    query = MultifieldParser(fields, ix.schema, fieldboosts=boosts).parse(expression)
+    with ix.searcher() as searcher:
+        results = searcher.search_page(query, page, pagelen=per_page)
+        # whoosh falls back to the last page when asked for one past the end
+        if results.pagenum != page:
+            return [], len(results)
+        return [int(hit['id']) for hit in results], len(results)
@@ -0,0 +1,123 @@
+"""
+A benchmark of the database engine profiles, see app.database
+Runs a mix of catalog reads and book writes from concurrent threads against a
+SQLite file set up with SQLite's own defaults and with the tuned profile in Config,
+and reports the operations per second and the p99 latency of reads and writes
+
+    python benchmarks/database.py --threads 8 --seconds 10 --books 20000 --writes 0.1
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# importing the app reads the config, which needs a database url
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+from config import Config  # noqa: E402
+from app import create_app, db  # noqa: E402
+from app.models import Book  # noqa: E402
+
+# SQLite's defaults, and a connection opened for every request as Flask-SQLAlchemy does
+PROFILES = {
+    'defaults': {'DATABASE_POOL_SIZE': 0,
+                 'SQLITE_PRAGMAS': {'journal_mode': 'delete', 'synchronous': 'full'}},
+    # pooled connections alone, to tell their share of the difference from the PRAGMAs'
+    'pooled': {'DATABASE_POOL_SIZE': Config.DATABASE_POOL_SIZE,
+               'SQLITE_PRAGMAS': {'journal_mode': 'delete', 'synchronous': 'full'}},
+    'tuned': {'DATABASE_POOL_SIZE': Config.DATABASE_POOL_SIZE,
+              'SQLITE_PRAGMAS': Config.SQLITE_PRAGMAS},
+}
+
+
+def percentile(latencies, fraction):
+    """
+    returns the latency below which the given fraction of the sorted latencies fall, in milliseconds
+    """
+    if not latencies:
+        return float('nan')
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+
+def run(settings, path, threads, seconds, books, writes):
+    """
+    Lets threads read and write the catalog for a number of seconds
+    returns the latencies of the reads and of the writes
+    """
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config.update(settings)
+    table = Book.__table__
+    reads, written = [], []
+    deadline = time.perf_counter() + seconds
+
+    def client(seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                book_id = rng.randint(1, books)
+                started = time.perf_counter()
+                if rng.random() < writes:
+                    db.session.execute(table.update().where(table.c.id == book_id).values(updated_at=datetime.utcnow()))
+                    db.session.commit()
+                    written.append(time.perf_counter() - started)
+                else:
+                    # a book page and a page of the home page's grid
+                    db.session.get(Book, book_id)
+                    db.session.query(Book.id, Book.title, Book.img_url) \
+                        .filter(Book.id > book_id).order_by(Book.id).limit(24).all()
+                    reads.append(time.perf_counter() - started)
+                # every request ends by handing its connection back
+                db.session.remove()
+
+    workers = [threading.Thread(target=client, args=(seed,)) for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    with app.app_context():
+        db.engine.dispose()
+    return sorted(reads), sorted(written)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--threads', type=int, default=8, help='Concurrent clients.')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each run.')
+    parser.add_argument('--books', type=int, default=20000, help='Books in the catalog.')
+    parser.add_argument('--writes', type=float, default=0.1, help='Share of the operations that write.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print(f'{args.threads} threads, {args.seconds:g}s per profile, {args.books} books, '
+              f'{args.writes:.0%} writes, {os.cpu_count()} CPUs')
+        print(f'{"profile":>9} {"ops/s":>8} {"reads/s":>8} {"writes/s":>8} {"read p99 ms":>12} {"write p99 ms":>13}')
+        for name, settings in PROFILES.items():
+            path = os.path.join(directory, f'{name}.db')
+            app = create_app()
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+            with app.app_context():
+                db.create_all()
+                db.session.execute(Book.__table__.insert(), [
+                    {'title': f'Book {i}', 'title_key': f'book {i}', 'synopsis': 'A synopsis',
+                     'img_url': f'{i}.jpg', 'copies_total': 1, 'copies_available': 1}
+                    for i in range(1, args.books + 1)])
+                db.session.commit()
+                db.session.remove()
+                db.engine.dispose()
+            reads, written = run(settings, path, args.threads, args.seconds, args.books, args.writes)
+            print(f'{name:>9} {(len(reads) + len(written)) / args.seconds:>8.0f} {len(reads) / args.seconds:>8.0f} '
+                  f'{len(written) / args.seconds:>8.0f} {percentile(reads, 0.99):>12.1f} '
+                  f'{percentile(written, 0.99):>13.1f}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+A microbenchmark of the password hasher, see app.passwords
+Runs a login storm of concurrent password checks against pools of several sizes
+and reports the hashes per second and the p99 latency of a single check
+
+    python benchmarks/passwords.py --clients 16 --logins 20 --workers 0 1 2 4
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# importing the app reads the config, which needs a database url
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+from app.passwords import PasswordHasher  # noqa: E402
+
+
+def storm(hasher, pwhash, clients, logins):
+    """
+    Lets clients threads check logins passwords each, as fast as the hasher allows
+    returns the latencies of every check in seconds and the wall time of the storm
+    """
+    def login(_):
+        started = time.perf_counter()
+        hasher.check(pwhash, 'password')
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as threads:
+        latencies = list(threads.map(login, range(clients * logins)))
+    return latencies, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--method', default='pbkdf2:sha256:260000')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent logins.')
+    parser.add_argument('--logins', type=int, default=20, help='Logins per client.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4], help='Pool sizes to try.')
+    args = parser.parse_args()
+
+    print(f'{args.method}, {args.clients} clients x {args.logins} logins, {os.cpu_count()} CPUs')
+    print(f'{"workers":>8} {"hashes/s":>10} {"p50 ms":>8} {"p99 ms":>8}')
+    for workers in args.workers:
+        # a queue as long as the storm, so no login is turned away while measuring
+        hasher = PasswordHasher({'PASSWORD_HASH_METHOD': args.method, 'PASSWORD_HASH_WORKERS': workers,
+                                 'PASSWORD_HASH_QUEUE': args.clients})
+        pwhash = hasher.generate('password')
+        latencies, elapsed = storm(hasher, pwhash, args.clients, args.logins)
+        hasher.shutdown()
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        print(f'{workers:>8} {len(latencies) / elapsed:>10.1f} {p50:>8.1f} {p99:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -16,9 +16,121 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://", 1) or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connections kept open per worker process and how many more may be opened under load,
+    # a request waits up to DATABASE_POOL_TIMEOUT seconds for one beyond that
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 5)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT') or 30)
+    # Database servers only: seconds before a connection is replaced, whether connections
+    # are tested before use, and milliseconds a PostgreSQL statement may run (0 for no limit)
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE') or 1800)
+    DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', '1') == '1'
+    DATABASE_STATEMENT_TIMEOUT = int(os.environ.get('DATABASE_STATEMENT_TIMEOUT') or 30000)
+    # Read-only replicas of the database, comma separated. The reads of GET requests go to one
+    # of them, except for clients that wrote within the last REPLICA_STICKY_SECONDS seconds
+    DATABASE_REPLICA_URLS = [url.strip().replace("postgres://", "postgresql://", 1)
+                             for url in (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',') if url.strip()]
+    SQLALCHEMY_BINDS = {f'replica{i}': url for i, url in enumerate(DATABASE_REPLICA_URLS)}
+    DATABASE_REPLICAS = list(SQLALCHEMY_BINDS)
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
+    # Where the clients that wrote lately are remembered by name, for API clients that don't
+    # send cookies back: 'sqlite' shares them between the workers of a host, 'memory' keeps them per worker
+    REPLICA_STICKY_BACKEND = os.environ.get('REPLICA_STICKY_BACKEND') or 'sqlite'
+    REPLICA_STICKY_PATH = os.environ.get('REPLICA_STICKY_PATH') or os.path.join(basedir, 'recent_writers.db')
+    REPLICA_STICKY_SIZE = int(os.environ.get('REPLICA_STICKY_SIZE') or 10000)
+    # PRAGMAs run on every SQLite connection: WAL lets readers carry on while a write
+    # commits, NORMAL syncs the WAL at checkpoints only, and each connection keeps a
+    # memory map of the file and a page cache (negative sizes are in KiB)
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE') or 'wal',
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS') or 'normal',
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024),
+        'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE') or -64000),
+    }
     BOOK_IMAGES_DIR = 'static/images/books'
+    # Widths in pixels of the resized copies made of every book cover
+    COVER_SIZES = {'thumb': 160, 'card': 320, 'detail': 640}
+    # Covers with more pixels than this are rejected before they are decoded
+    COVER_MAX_PIXELS = int(os.environ.get('COVER_MAX_PIXELS') or 40_000_000)
+    # Cover files written within this many seconds are never deleted, as a book being
+    # created may have just deduplicated onto them
+    COVER_DELETE_GRACE = int(os.environ.get('COVER_DELETE_GRACE') or 600)
+    # Let the web server send cover files, either through X-Sendfile or, when set to
+    # an internal location such as /protected/covers/, through nginx's X-Accel-Redirect
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+    COVERS_ACCEL_REDIRECT = os.environ.get('COVERS_ACCEL_REDIRECT')
     # Limit maximum length of book cover image to 5MB
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024
-    WHOOSH_BASE = 'whoosh'
+    # Directory holding the full-text search indexes
+    WHOOSH_BASE = os.environ.get('WHOOSH_BASE') or os.path.join(basedir, 'whoosh')
+    # Number of books inserted per transaction by bulk imports
+    BULK_IMPORT_BATCH_SIZE = int(os.environ.get('BULK_IMPORT_BATCH_SIZE') or 1000)
+    # Largest body accepted by POST /api/books/bulk, which streams it instead of buffering it
+    BULK_IMPORT_MAX_CONTENT_LENGTH = int(os.environ.get('BULK_IMPORT_MAX_CONTENT_LENGTH') or 512 * 1024 * 1024)
+    # Number of days a borrowed book may be kept
+    LOAN_PERIOD_DAYS = int(os.environ.get('LOAN_PERIOD_DAYS') or 14)
+    # Number of overdue loans read per round-trip by 'flask loans overdue'
+    OVERDUE_BATCH_SIZE = int(os.environ.get('OVERDUE_BATCH_SIZE') or 1000)
+    # Days before a loan that is still overdue is reminded again
+    OVERDUE_REMINDER_INTERVAL = int(os.environ.get('OVERDUE_REMINDER_INTERVAL') or 7)
+    # Background jobs are retried this many times, waiting JOB_RETRY_DELAY seconds
+    # before the first retry and twice as long before each following one
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY') or 10)
+    # Running jobs renew their lock every JOB_HEARTBEAT_INTERVAL seconds, one whose lock
+    # hasn't been renewed for JOB_TIMEOUT seconds lost its worker and is queued again
+    JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL') or 30)
+    JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT') or 600)
+    # Number of books shown per page of the web interface
+    BOOKS_PER_PAGE = int(os.environ.get('BOOKS_PER_PAGE') or 24)
+    # Number of books the admin dashboard shows per page
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE') or 50)
+    # Default and maximum number of items returned per page by the API
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE') or 50)
+    API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE') or 200)
+    # Number of rows fetched per round-trip when streaming the whole catalog
+    API_STREAM_BATCH_SIZE = int(os.environ.get('API_STREAM_BATCH_SIZE') or 1000)
+    # Bound the number of verified API tokens kept in memory and for how long (seconds)
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 1024)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+    # Bound the number of logged in users kept in memory and for how long (seconds),
+    # a user's changes reach the other workers within TOKEN_REVOCATION_REFRESH seconds regardless
+    IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE') or 1024)
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 60)
+    # werkzeug method and cost of password hashes, stored hashes made otherwise are
+    # replaced on the user's next successful login
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    # Processes hashing passwords (0 hashes on the request thread) and how many more
+    # passwords may wait for one before logins are turned away with a 503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    # Rate limits, as 'requests/seconds', of the endpoints checking passwords or signing up
+    # users and of the admin writes, applied per client IP and per username
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+    RATELIMIT_AUTH = os.environ.get('RATELIMIT_AUTH') or '10/60'
+    RATELIMIT_WRITE = os.environ.get('RATELIMIT_WRITE') or '120/60'
+    # 'sqlite' shares the buckets and the in-flight count between the workers of a host
+    # through a local file, 'memory' keeps them per worker process
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'sqlite'
+    RATELIMIT_SQLITE_PATH = os.environ.get('RATELIMIT_SQLITE_PATH') or os.path.join(basedir, 'ratelimit.db')
+    # Rate limited requests the server runs at once before turning others away with a 503, 0 for no cap
+    # A request still counted after RATELIMIT_IN_FLIGHT_TIMEOUT seconds belongs to a killed
+    # worker and stops counting, gunicorn kills workers silent for 30 seconds by default
+    RATELIMIT_MAX_IN_FLIGHT = int(os.environ.get('RATELIMIT_MAX_IN_FLIGHT') or 8)
+    RATELIMIT_IN_FLIGHT_TIMEOUT = int(os.environ.get('RATELIMIT_IN_FLIGHT_TIMEOUT') or 30)
+    # Proxies in front of the app whose X-Forwarded-For and X-Forwarded-Proto are trusted,
+    # 1 for the Heroku router, 0 when clients connect to gunicorn directly
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES') or 1)
+    # Seconds an API token stays valid
+    TOKEN_LIFETIME = int(os.environ.get('TOKEN_LIFETIME') or 30 * 60)
+    # Tokens are verified from their claims, revoking a user's tokens (on update or deletion)
+    # goes through the database and reaches the other workers within this many seconds
+    TOKEN_REVOCATION_REFRESH = float(os.environ.get('TOKEN_REVOCATION_REFRESH') or 5)
+    # Cache of serialized book responses: 'memory' keeps one per worker,
+    # 'sqlite' shares one file between all workers and 'none' turns it off
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND') or 'memory'
+    RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH') or os.path.join(basedir, 'response_cache.db')
+    RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE') or 2048)
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 600)
 
 # os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://", 1)
\ No newline at end of file
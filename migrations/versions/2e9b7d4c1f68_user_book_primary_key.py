@@ -0,0 +1,44 @@
+"""user book primary key
+
+Revision ID: 2e9b7d4c1f68
+Revises: 7c3e5f1a9b42
+Create Date: 2026-10-18 23:58:02.114936
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e9b7d4c1f68'
+down_revision = '7c3e5f1a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the table is rebuilt so duplicate and incomplete loans can be dropped on the way
+    op.create_table('user_book_new',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('book_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['book_id'], ['book.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'book_id')
+    )
+    op.execute('INSERT INTO user_book_new (user_id, book_id) '
+               'SELECT DISTINCT user_id, book_id FROM user_book '
+               'WHERE user_id IS NOT NULL AND book_id IS NOT NULL')
+    op.drop_table('user_book')
+    op.rename_table('user_book_new', 'user_book')
+
+
+def downgrade():
+    op.create_table('user_book_old',
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('book_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['book_id'], ['book.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO user_book_old (user_id, book_id) SELECT user_id, book_id FROM user_book')
+    op.drop_table('user_book')
+    op.rename_table('user_book_old', 'user_book')
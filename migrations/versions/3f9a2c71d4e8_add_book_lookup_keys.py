@@ -0,0 +1,51 @@
+"""add book lookup keys
+
+Revision ID: 3f9a2c71d4e8
+Revises: c472c024d7cb
+Create Date: 2026-10-18 21:02:11.418201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a2c71d4e8'
+down_revision = 'c472c024d7cb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('title_key', sa.String(length=1500), nullable=True))
+        batch_op.add_column(sa.Column('author_key', sa.String(length=150), nullable=True))
+
+    # backfill the keys of existing books, casefolding is done in python
+    # so that the keys match those set by the Book model
+    book = sa.table('book',
+        sa.column('id', sa.Integer),
+        sa.column('title', sa.String),
+        sa.column('author', sa.String),
+        sa.column('title_key', sa.String),
+        sa.column('author_key', sa.String)
+    )
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(book.c.id, book.c.title, book.c.author)).fetchall()
+    for id, title, author in rows:
+        connection.execute(book.update().where(book.c.id == id).values(
+            title_key=title.strip().casefold() if title is not None else None,
+            author_key=author.strip().casefold() if author is not None else None
+        ))
+
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_book_title_key'), ['title_key'], unique=False)
+        batch_op.create_index(batch_op.f('ix_book_author_key'), ['author_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_book_author_key'))
+        batch_op.drop_index(batch_op.f('ix_book_title_key'))
+        batch_op.drop_column('author_key')
+        batch_op.drop_column('title_key')
@@ -0,0 +1,39 @@
+"""add updated_at to book and user
+
+Revision ID: 5d2f8a6c3e71
+Revises: a4c7e2b9f016
+Create Date: 2026-10-18 22:31:45.120377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2f8a6c3e71'
+down_revision = 'a4c7e2b9f016'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_book_updated_at'), ['updated_at'], unique=False)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_updated_at'), ['updated_at'], unique=False)
+
+    op.execute("UPDATE book SET updated_at = CURRENT_TIMESTAMP")
+    op.execute("UPDATE \"user\" SET updated_at = CURRENT_TIMESTAMP")
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_updated_at'))
+        batch_op.drop_column('updated_at')
+
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_book_updated_at'))
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,32 @@
+"""add book sort indexes
+
+Revision ID: 6b8e2d4f9c17
+Revises: f1b7c3d9a285
+Create Date: 2026-10-19 09:12:05.441728
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b8e2d4f9c17'
+down_revision = 'f1b7c3d9a285'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.create_index('ix_book_title_key_id', ['title_key', 'id'], unique=False)
+        batch_op.create_index('ix_book_author_key_id', ['author_key', 'id'], unique=False)
+        batch_op.create_index('ix_book_year_of_publish_id', ['year_of_publish', 'id'], unique=False)
+        batch_op.create_index('ix_book_updated_at_id', ['updated_at', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_index('ix_book_updated_at_id')
+        batch_op.drop_index('ix_book_year_of_publish_id')
+        batch_op.drop_index('ix_book_author_key_id')
+        batch_op.drop_index('ix_book_title_key_id')
@@ -0,0 +1,31 @@
+"""add counter table
+
+Revision ID: 8b1d6e0f5a93
+Revises: 3f9a2c71d4e8
+Create Date: 2026-10-18 21:24:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1d6e0f5a93'
+down_revision = '3f9a2c71d4e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counter',
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # seed the counters with the current totals
+    op.execute("INSERT INTO counter (name, value) SELECT 'book', count(*) FROM book")
+    op.execute("INSERT INTO counter (name, value) SELECT 'user', count(*) FROM \"user\"")
+
+
+def downgrade():
+    op.drop_table('counter')
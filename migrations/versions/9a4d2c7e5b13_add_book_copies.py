@@ -0,0 +1,37 @@
+"""add book copies
+
+Revision ID: 9a4d2c7e5b13
+Revises: 2e9b7d4c1f68
+Create Date: 2026-10-19 00:22:47.590318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4d2c7e5b13'
+down_revision = '2e9b7d4c1f68'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('copies_total', sa.Integer(), server_default='1', nullable=False))
+        batch_op.add_column(sa.Column('copies_available', sa.Integer(), server_default='1', nullable=False))
+
+    # books lent to several users at once get a copy for each of them
+    loans = '(SELECT COUNT(*) FROM user_book WHERE user_book.book_id = book.id)'
+    op.execute(f'UPDATE book SET copies_total = {loans} WHERE {loans} > 1')
+    op.execute(f'UPDATE book SET copies_available = copies_total - {loans}')
+
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.create_check_constraint('ck_book_copies', 'copies_available >= 0 AND copies_available <= copies_total')
+
+
+def downgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_constraint('ck_book_copies', type_='check')
+        batch_op.drop_column('copies_available')
+        batch_op.drop_column('copies_total')
@@ -0,0 +1,30 @@
+"""add catalog version
+
+Revision ID: a4c7e2b9f016
+Revises: 8b1d6e0f5a93
+Create Date: 2026-10-18 21:47:03.551920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c7e2b9f016'
+down_revision = '8b1d6e0f5a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('counter', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    op.execute("UPDATE counter SET updated_at = CURRENT_TIMESTAMP")
+    op.execute("INSERT INTO counter (name, value, updated_at) VALUES ('catalog_version', 1, CURRENT_TIMESTAMP)")
+
+
+def downgrade():
+    op.execute("DELETE FROM counter WHERE name = 'catalog_version'")
+    with op.batch_alter_table('counter', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,35 @@
+"""add deletion table
+
+Revision ID: c5e9a3f7b214
+Revises: 6b8e2d4f9c17
+Create Date: 2026-10-19 11:04:52.317904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e9a3f7b214'
+down_revision = '6b8e2d4f9c17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('deletion',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=32), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('deletion', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_deletion_deleted_at'), ['deleted_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('deletion', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_deletion_deleted_at'))
+
+    op.drop_table('deletion')
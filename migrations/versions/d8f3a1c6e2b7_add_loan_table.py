@@ -0,0 +1,53 @@
+"""add loan table
+
+Revision ID: d8f3a1c6e2b7
+Revises: 9a4d2c7e5b13
+Create Date: 2026-10-19 00:51:13.804725
+
+"""
+from datetime import datetime, timedelta
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8f3a1c6e2b7'
+down_revision = '9a4d2c7e5b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('loan',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('book_id', sa.Integer(), nullable=True),
+    sa.Column('borrowed_at', sa.DateTime(), nullable=False),
+    sa.Column('due_at', sa.DateTime(), nullable=False),
+    sa.Column('returned_at', sa.DateTime(), nullable=True),
+    sa.Column('reminded_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['book_id'], ['book.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('loan', schema=None) as batch_op:
+        batch_op.create_index('ix_loan_open_due_at', ['due_at', 'id'], unique=False,
+                              sqlite_where=sa.text('returned_at IS NULL'),
+                              postgresql_where=sa.text('returned_at IS NULL'))
+        batch_op.create_index('ix_loan_user_id_borrowed_at', ['user_id', 'borrowed_at'], unique=False)
+
+    # books on loan today start their history now, with a full loan period ahead of them
+    now = datetime.utcnow()
+    op.get_bind().execute(
+        sa.text('INSERT INTO loan (user_id, book_id, borrowed_at, due_at) '
+                'SELECT user_id, book_id, :now, :due FROM user_book'),
+        now=now, due=now + timedelta(days=current_app.config['LOAN_PERIOD_DAYS']))
+
+
+def downgrade():
+    with op.batch_alter_table('loan', schema=None) as batch_op:
+        batch_op.drop_index('ix_loan_user_id_borrowed_at')
+        batch_op.drop_index('ix_loan_open_due_at')
+
+    op.drop_table('loan')
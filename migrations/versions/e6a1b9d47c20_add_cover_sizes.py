@@ -0,0 +1,30 @@
+"""add resized cover columns
+
+Revision ID: e6a1b9d47c20
+Revises: 5d2f8a6c3e71
+Create Date: 2026-10-18 23:05:12.664810
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a1b9d47c20'
+down_revision = '5d2f8a6c3e71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('img_thumb', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('img_card', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('img_detail', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('book', schema=None) as batch_op:
+        batch_op.drop_column('img_detail')
+        batch_op.drop_column('img_card')
+        batch_op.drop_column('img_thumb')
@@ -0,0 +1,33 @@
+"""add token revocation table
+
+Revision ID: f1b7c3d9a285
+Revises: d8f3a1c6e2b7
+Create Date: 2026-10-19 01:37:40.218466
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1b7c3d9a285'
+down_revision = 'd8f3a1c6e2b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('token_revocation',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('revoked_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    with op.batch_alter_table('token_revocation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_token_revocation_revoked_at'), ['revoked_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('token_revocation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_token_revocation_revoked_at'))
+
+    op.drop_table('token_revocation')
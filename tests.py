@@ -6,11 +6,46 @@ import os
 # use an in memory db for tests above all imports
 # ensures that variable is correctly set by the time config file is imported
 os.environ['DATABASE_URL'] = 'sqlite://'
+# hash passwords inline and cheaply, the pool has tests of its own
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+# the rate limits have tests of their own, keep the others from hitting them
+os.environ['RATELIMIT_ENABLED'] = '0'
+os.environ['RATELIMIT_STORAGE'] = 'memory'
+os.environ['REPLICA_STICKY_BACKEND'] = 'memory'
 
+import base64
+import csv
+import datetime
+import gzip
+import io
+import shutil
+import tempfile
+import threading
+import time
+import json
+import re
 import unittest
+import jwt
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 from flask import current_app
-from app.models import Book, User
+from app.models import Book, BookUnavailable, User, Counter, Job, Loan, TokenRevocation, user_book, borrow, give_back, \
+    current_loans
+from PIL import Image
 from app import create_app, db
+from werkzeug.datastructures import FileStorage
+from app.images import make_thumbnails, store_cover, delete_cover_files
+from app.ratelimit import RateLimiter, SQLiteBucketStore
+from app.identity import load_user
+from app.admin.routes import DASHBOARD_COLUMNS, SORTS
+from app.database import pool_stats
+from app.api.v1.pagination import encode_cursor
+from app.jobs import enqueue, claim_job, handlers, job, requeue_stale, run_job, work
+from app.cache import SQLiteCache
+from app.passwords import PasswordHasher, HasherBusy
+from app.loans import overdue_loans
+from app.importer import import_books
 
 
 class BaseTestCase(unittest.TestCase):
@@ -23,6 +58,8 @@ class BaseTestCase(unittest.TestCase):
         """
         # create an instance of our app
         self.app = create_app()
+        # keep the search index of each test apart
+        self.app.config['WHOOSH_BASE'] = tempfile.mkdtemp()
         # load up everything we need to create the app
         self.appctx = self.app.app_context()
         # push context to application_context stack
@@ -38,6 +75,7 @@ class BaseTestCase(unittest.TestCase):
         Destroy temporary database
         """
         db.drop_all()
+        shutil.rmtree(self.app.config['WHOOSH_BASE'])
         self.appctx.pop()
         self.app = None
         self.appctx = None
@@ -99,6 +137,45 @@ class UserModelCase(BaseTestCase):
         self.assertTrue(u.check_password('StringPassword'))
         self.assertFalse(u.check_password('NotStringPassword'))
 
+    def test_rehash_on_login(self):
+        """
+        Test that a hash made with an older cost is replaced on the next login
+        """
+        u = User(name="String", email="string@email.com")
+        u.set_password('StringPassword')
+        self.app.password_hasher.method = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('NotStringPassword'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('StringPassword'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('StringPassword'))
+
+    def test_hashing_pool(self):
+        """
+        Test that passwords are hashed in worker processes and excess work is turned away
+        """
+        hasher = PasswordHasher({'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+                                 'PASSWORD_HASH_WORKERS': 1, 'PASSWORD_HASH_QUEUE': 0})
+        self.addCleanup(hasher.shutdown)
+        pwhash = hasher.generate('StringPassword')
+        self.assertTrue(hasher.check(pwhash, 'StringPassword'))
+        hasher.slots.acquire()
+        with self.assertRaises(HasherBusy):
+            hasher.check(pwhash, 'StringPassword')
+        hasher.slots.release()
+
+    def test_busy_hasher_answers_503(self):
+        """
+        Test that a full hasher turns token requests away with Retry-After
+        """
+        def busy(*args):
+            raise HasherBusy("busy")
+        self.app.password_hasher.run = busy
+        response = self.client().get('/api/token', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b"username:password").decode()})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
 
 # unit tests for the book model
 class BookModelCase(BaseTestCase):
@@ -119,6 +196,301 @@ class BookModelCase(BaseTestCase):
         self.assertEqual(book.title, "Short Story")
         self.assertEqual(book.author, "Story A. Teller")
         self.assertEqual(book.year_of_publish, 2000)
+        self.assertEqual(book.title_key, "short story")
+        self.assertEqual(book.author_key, "story a. teller")
+
+    def test_borrow_and_give_back(self):
+        """
+        Test that loans are recorded once and only for existing books
+        """
+        self.assertTrue(borrow(1, 1))
+        self.assertFalse(borrow(1, 1))
+        self.assertFalse(borrow(1, 999))
+        db.session.commit()
+        self.assertEqual([loan.book.id for loan in current_loans(1)], [1])
+        self.assertEqual(User.query.get(1).loan_count(), 1)
+        self.assertEqual(Book.query.get(1).copies_available, 0)
+        self.assertTrue(give_back(1, 1))
+        self.assertFalse(give_back(1, 1))
+        self.assertEqual(Book.query.get(1).copies_available, 1)
+
+    def test_relationships_never_load_on_access(self):
+        """
+        Test that borrowed_books and borrowers have to be loaded explicitly, in one query per side
+        """
+        db.session.add(Book(title="Another", synopsis="Another read"))
+        db.session.commit()
+        borrow(1, 1)
+        borrow(1, 2)
+        db.session.commit()
+        db.session.expunge_all()
+        with self.assertRaises(InvalidRequestError):
+            User.query.get(1).borrowed_books
+        db.session.expunge_all()
+        books = Book.query.options(db.selectinload(Book.borrowers)).order_by(Book.id).all()
+        self.assertEqual([[user.name for user in book.borrowers] for book in books], [["username"], ["username"]])
+
+    def test_last_copy(self):
+        """
+        Test that a book can't be lent out once its copies are gone
+        """
+        db.session.add(User(name="other", email="other@email.com"))
+        db.session.commit()
+        self.assertTrue(borrow(1, 1))
+        with self.assertRaises(BookUnavailable):
+            borrow(2, 1)
+        db.session.commit()
+        self.assertEqual(db.session.query(user_book).count(), 1)
+        book = Book.query.get(1)
+        book.set_copies_total(3)
+        db.session.commit()
+        self.assertEqual((book.copies_total, book.copies_available), (3, 2))
+        with self.assertRaises(ValueError):
+            book.set_copies_total(0)
+
+    def test_copies_lent_meanwhile(self):
+        """
+        Test that the check constraint catches a total lowered below copies lent out meanwhile
+        """
+        book = Book.query.get(1)
+        self.assertEqual(book.copies_available, 1)
+        borrow(1, 1)
+        book.set_copies_total(0)
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_deleted_borrower_returns_copies(self):
+        """
+        Test that deleting a user puts the books they held back on the shelf
+        """
+        book = Book.query.get(1)
+        book.set_copies_total(2)
+        db.session.commit()
+        borrow(1, 1)
+        db.session.commit()
+        db.session.delete(User.query.get(1))
+        db.session.commit()
+        self.assertEqual(Book.query.get(1).copies_available, 2)
+        self.assertEqual(db.session.query(user_book).count(), 0)
+        loan = Loan.query.one()
+        self.assertIsNotNone(loan.returned_at)
+        self.assertEqual((loan.user_id, loan.book_id), (None, 1))
+
+    def test_deleted_book_keeps_its_loans(self):
+        """
+        Test that deleting a book closes its loans and keeps them in the ledger
+        """
+        borrow(1, 1)
+        give_back(1, 1)
+        borrow(1, 1)
+        db.session.commit()
+        db.session.delete(Book.query.get(1))
+        db.session.commit()
+        loans = Loan.query.all()
+        self.assertEqual(len(loans), 2)
+        self.assertTrue(all(loan.book_id is None and loan.returned_at is not None for loan in loans))
+        self.assertEqual([loan.user_id for loan in loans], [1, 1])
+
+
+# unit tests for the cover images
+class ImagesTestCase(BaseTestCase):
+    """
+    Unit test for resizing book covers
+    """
+    def setUp(self):
+        super().setUp()
+        self.app.config['BOOK_IMAGES_DIR'] = tempfile.mkdtemp()
+        Image.new('RGB', (1000, 1500), 'blue').save(os.path.join(self.app.config['BOOK_IMAGES_DIR'], 'cover.png'))
+
+    def tearDown(self):
+        shutil.rmtree(self.app.config['BOOK_IMAGES_DIR'])
+        super().tearDown()
+
+    def test_make_thumbnails(self):
+        book = Book(title="Covered", synopsis="A synopsis", img_url='cover.png')
+        make_thumbnails(book)
+        for name, width in self.app.config['COVER_SIZES'].items():
+            file_name = getattr(book, 'img_' + name)
+            with Image.open(os.path.join(self.app.config['BOOK_IMAGES_DIR'], file_name)) as image:
+                self.assertEqual(image.size, (width, width * 3 // 2))
+
+    def test_process_cover_job(self):
+        book = Book(title="Covered", synopsis="A synopsis", img_url='cover.png')
+        db.session.add(book)
+        db.session.flush()
+        enqueue('process_cover', book_id=book.id)
+        db.session.commit()
+        self.assertIsNone(book.img_thumb)
+        work(burst=True)
+        self.assertIsNotNone(Book.query.get(book.id).img_thumb)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_rebuild_command(self):
+        db.session.add(Book(title="Covered", synopsis="A synopsis", img_url='cover.png'))
+        db.session.add(Book(title="Missing", synopsis="A synopsis", img_url='missing.png'))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['images', 'rebuild', '--workers', '2'])
+        self.assertIn("1 covers resized, 1 failed", result.output)
+        self.assertIsNotNone(Book.query.filter_by(title="Covered").first().img_card)
+
+    def upload(self, size=(300, 450)):
+        data = io.BytesIO()
+        Image.new('RGB', size, 'red').save(data, 'JPEG')
+        data.seek(0)
+        return FileStorage(data, filename='cover.jpeg')
+
+    def test_store_cover_deduplicates(self):
+        first = store_cover(self.upload())
+        second = store_cover(self.upload())
+        self.assertEqual(first, second)
+        self.assertTrue(first.endswith('.jpg'))
+        self.assertEqual(sorted(os.listdir(self.app.config['BOOK_IMAGES_DIR'])), sorted(['cover.png', first]))
+
+    def test_store_cover_rejects_huge_images(self):
+        self.app.config['COVER_MAX_PIXELS'] = 1000
+        with self.assertRaises(ValueError):
+            store_cover(self.upload())
+        self.assertEqual(os.listdir(self.app.config['BOOK_IMAGES_DIR']), ['cover.png'])
+
+    def test_cover_is_immutable(self):
+        response = self.app.test_client().get('/books/covers/cover.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertNotEqual(self.app.test_client().get('/books/covers/missing.png').status_code, 200)
+
+    def test_cover_accel_redirect(self):
+        self.app.config['COVERS_ACCEL_REDIRECT'] = '/protected/covers/'
+        response = self.app.test_client().get('/books/covers/cover.png')
+        self.assertEqual(response.headers['X-Accel-Redirect'], '/protected/covers/cover.png')
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertNotEqual(self.app.test_client().get('/books/covers/missing.png').status_code, 200)
+
+    def test_shared_cover_is_kept(self):
+        self.app.config['COVER_DELETE_GRACE'] = 0
+        db.session.add(Book(title="Covered", synopsis="A synopsis", img_url='cover.png'))
+        db.session.commit()
+        delete_cover_files(['cover.png', 'cover_thumb.webp'])
+        self.assertTrue(os.path.exists(os.path.join(self.app.config['BOOK_IMAGES_DIR'], 'cover.png')))
+        Book.query.delete()
+        db.session.commit()
+        delete_cover_files(['cover.png'])
+        self.assertFalse(os.path.exists(os.path.join(self.app.config['BOOK_IMAGES_DIR'], 'cover.png')))
+
+    def test_recent_cover_outlives_pending_delete(self):
+        """
+        Test that a cover deduplicated onto by a book not committed yet survives the deletion
+        of the cover's previous book
+        """
+        file_name = store_cover(self.upload())
+        path = os.path.join(self.app.config['BOOK_IMAGES_DIR'], file_name)
+        enqueue('delete_cover_files', file_names=[file_name])
+        db.session.commit()
+        work(burst=True)
+        self.assertTrue(os.path.exists(path))
+        # checked again once the grace period is over, and removed if still unused
+        retry = Job.query.one()
+        self.assertGreater(retry.run_at, datetime.datetime.utcnow())
+        old = time.time() - self.app.config['COVER_DELETE_GRACE'] - 1
+        os.utime(path, (old, old))
+        self.assertEqual(delete_cover_files([file_name]), [])
+        self.assertFalse(os.path.exists(path))
+        # a later upload of the same cover puts it back
+        self.assertEqual(store_cover(self.upload()), file_name)
+        self.assertTrue(os.path.exists(path))
+
+
+# unit tests for the loan ledger
+class LoansTestCase(BaseTestCase):
+    """
+    Unit test for loan history and overdue reminders
+    """
+    def test_ledger(self):
+        borrow(1, 1)
+        db.session.commit()
+        loan = Loan.query.one()
+        self.assertIsNone(loan.returned_at)
+        self.assertEqual((loan.due_at - loan.borrowed_at).days, self.app.config['LOAN_PERIOD_DAYS'])
+        give_back(1, 1)
+        borrow(1, 1)
+        db.session.commit()
+        self.assertEqual(Loan.query.count(), 2)
+        self.assertEqual(Loan.query.filter(Loan.returned_at.is_(None)).count(), 1)
+
+    def test_overdue_reminders(self):
+        now = datetime.datetime.utcnow()
+        for i in range(5):
+            db.session.add(Loan(user_id=1, book_id=1, borrowed_at=now, due_at=now - datetime.timedelta(days=i)))
+        db.session.add(Loan(user_id=1, book_id=1, borrowed_at=now, due_at=now - datetime.timedelta(days=9),
+                            returned_at=now))
+        db.session.add(Loan(user_id=1, book_id=1, borrowed_at=now, due_at=now + datetime.timedelta(days=1)))
+        db.session.commit()
+        batches = list(overdue_loans(now + datetime.timedelta(seconds=1), batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        due_dates = [row.due_at for batch in batches for row in batch]
+        self.assertEqual(due_dates, sorted(due_dates))
+        self.assertEqual(len({row.id for batch in batches for row in batch}), 5)
+
+        result = self.app.test_cli_runner().invoke(args=['loans', 'overdue', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("5 overdue reminders queued", result.output)
+        self.assertEqual(Loan.query.filter(Loan.reminded_at.isnot(None)).count(), 5)
+        # the borrower is gone, the reminders are dropped instead of retried
+        User.query.filter_by(id=1).delete()
+        db.session.commit()
+        work(burst=True)
+        self.assertEqual(Job.query.count(), 0)
+        # already reminded loans wait for OVERDUE_REMINDER_INTERVAL days
+        result = self.app.test_cli_runner().invoke(args=['loans', 'overdue'])
+        self.assertIn("0 overdue reminders queued", result.output)
+
+
+# unit tests for the background jobs
+class JobsTestCase(BaseTestCase):
+    """
+    Unit test for the job queue
+    """
+    def test_failed_job_is_retried_then_given_up(self):
+        self.app.config['JOB_MAX_ATTEMPTS'] = 2
+        self.app.config['JOB_RETRY_DELAY'] = 0
+        enqueue('delete_cover_files', file_names=None)
+        db.session.commit()
+        work(burst=True)
+        queued = Job.query.first()
+        self.assertEqual((queued.status, queued.attempts), ('failed', 2))
+        self.assertIn('TypeError', queued.last_error)
+
+    def test_stale_job_is_requeued(self):
+        enqueue('delete_cover_files', file_names=[])
+        db.session.commit()
+        claimed = claim_job()
+        self.assertIsNone(claim_job())
+        claimed.locked_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        db.session.commit()
+        self.assertEqual(requeue_stale(), 1)
+        work(burst=True)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_long_job_keeps_its_lock(self):
+        """
+        Test that a job running longer than JOB_TIMEOUT isn't queued again while it runs
+        """
+        self.app.config['JOB_HEARTBEAT_INTERVAL'] = 0.05
+        self.app.config['JOB_TIMEOUT'] = 0.3
+        requeued = []
+
+        @job('slow_job')
+        def slow_job():
+            time.sleep(0.6)
+            with self.app.app_context():
+                requeued.append(requeue_stale())
+        self.addCleanup(handlers.pop, 'slow_job')
+        enqueue('slow_job')
+        db.session.commit()
+        run_job(claim_job())
+        self.assertEqual(requeued, [0])
+        self.assertEqual(Job.query.count(), 0)
 
 
 # System Tests
@@ -188,5 +560,840 @@ class RoutesTestCase(BaseTestCase):
             self.assertEqual(response.request.path, '/auth/login')
 
 
+    def queries(self, c, path, **kwargs):
+        """
+        returns the response to a GET request along with the statements it ran
+        """
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        # start from an empty identity map, as a request on a worker does
+        db.session.remove()
+        db.event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = c.get(path, **kwargs)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', record)
+        return response, statements
+
+    def user_queries(self, c, path):
+        """
+        returns the response to a request along with the statements it ran against the user table
+        """
+        response, statements = self.queries(c, path)
+        return response, [statement for statement in statements if re.search(r'\bFROM "?user\b', statement)]
+
+    def web_login(self, c):
+        """
+        Logs the client in through the login form
+        """
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        response = c.post('/auth/login', data={"username": "username", "password": "password"})
+        self.assertEqual(response.status_code, 302)
+
+    def test_identity_cache(self):
+        with self.client() as c:
+            self.web_login(c)
+            response, statements = self.user_queries(c, '/books/my-books')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            response, statements = self.user_queries(c, '/books/my-books')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(statements, [])
+
+    def test_identity_cache_follows_changes(self):
+        with self.client() as c:
+            self.web_login(c)
+            c.get('/books/my-books')
+            token = c.get('/api/token', headers={
+                'Authorization': 'Basic ' + base64.b64encode(b"username:password").decode()}).get_json()['token']
+            c.put('/api/user/update', headers={'x-access-token': token},
+                  json={"name": "renamed", "email": "renamed@email.com"})
+            response, statements = self.user_queries(c, '/books/my-books')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(load_user('1').name, "renamed")
+
+
+    def test_query_counts(self):
+        """
+        Test that the pages and endpoints showing a user's books run a fixed number of
+        queries, however many books the user holds
+        """
+        self.app.config['TOKEN_REVOCATION_REFRESH'] = 3600
+        Book.query.get(1).img_url = "1.jpg"
+        db.session.add_all([Book(title=f"Book {i}", synopsis="Synopsis", img_url=f"{i}.jpg") for i in range(2, 5)])
+        db.session.commit()
+        # the nav bar's loan count is one of the queries of every page
+        budgets = {
+            '/books/my-books': 2,
+            '/books/show-book/1': 3,
+            '/': 2,
+            '/api/books/mine': 1,
+        }
+        with self.client() as c:
+            self.web_login(c)
+            token = c.get('/api/token', headers={
+                'Authorization': 'Basic ' + base64.b64encode(b"username:password").decode()}).get_json()['token']
+            for held in ([1], [1, 2, 3, 4]):
+                for book_id in held:
+                    borrow(1, book_id)
+                db.session.commit()
+                for path, budget in budgets.items():
+                    # warm the caches, then count the queries of a typical request
+                    c.get(path, headers={'x-access-token': token})
+                    response, statements = self.queries(c, path, headers={'x-access-token': token})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(statements), budget, (path, statements))
+
+    def test_home_pages(self):
+        self.app.config['BOOKS_PER_PAGE'] = 2
+        Book.query.get(1).img_url = "1.jpg"
+        db.session.add_all([Book(title=f"Book {i}", synopsis="Synopsis", img_url=f"{i}.jpg") for i in range(2, 4)])
+        db.session.commit()
+        with self.client() as c:
+            self.web_login(c)
+            page = c.get('/').get_data(as_text=True)
+            self.assertIn('alt="A book"', page)
+            self.assertIn('alt="Book 2"', page)
+            self.assertNotIn('alt="Book 3"', page)
+            self.assertIn('/index?after=2', page)
+            page = c.get('/index?after=2').get_data(as_text=True)
+            self.assertIn('alt="Book 3"', page)
+            self.assertNotIn('/index?after=', page)
+
+    def test_home_page_grid_cache(self):
+        Book.query.get(1).img_url = "1.jpg"
+        db.session.commit()
+        with self.client() as c:
+            self.web_login(c)
+            c.get('/')
+            hits = self.app.response_cache.stats()['hits']
+            self.assertIn('alt="A book"', c.get('/').get_data(as_text=True))
+            self.assertEqual(self.app.response_cache.stats()['hits'], hits + 1)
+            # a write to the catalog retires the cached grids
+            Book.query.get(1).title = "Renamed"
+            db.session.commit()
+            self.assertIn('alt="Renamed"', c.get('/').get_data(as_text=True))
+
+
+    def test_admin_dashboard(self):
+        self.app.config['ADMIN_PAGE_SIZE'] = 2
+        User.query.get(1).is_admin = True
+        db.session.add_all([
+            Book(title="The Hobbit", synopsis="S", author="Tolkien", year_of_publish=1937),
+            Book(title="The Hunger Games", synopsis="S", author="Collins", year_of_publish=2008),
+            Book(title="Theogony", synopsis="S", author="Hesiod"),
+            Book(title="Silmarillion", synopsis="S", author="Tolkien", year_of_publish=1977),
+        ])
+        db.session.commit()
+        with self.client() as c:
+            self.web_login(c)
+
+            def walk(query):
+                titles, after = [], ''
+                while True:
+                    data = c.get(f'/admin/books?{query}&after={after}').get_json()
+                    self.assertLessEqual(len(data['books']), 2)
+                    titles += [book['title'] for book in data['books']]
+                    if data['next'] is None:
+                        return titles
+                    after = data['next']
+
+            # books without a year come last either way
+            self.assertEqual(walk('sort=year'), ["The Hobbit", "Silmarillion", "The Hunger Games", "A book", "Theogony"])
+            self.assertEqual(walk('sort=year&order=desc'),
+                             ["The Hunger Games", "Silmarillion", "The Hobbit", "Theogony", "A book"])
+            self.assertEqual(walk('sort=title&title=the%20h'), ["The Hobbit", "The Hunger Games"])
+            self.assertEqual(walk('sort=updated&author=TOLKIEN'), ["The Hobbit", "Silmarillion"])
+            self.assertEqual(walk('year=2008'), ["The Hunger Games"])
+            self.assertEqual(c.get('/admin/books?sort=synopsis').status_code, 400)
+            self.assertEqual(c.get('/admin/books?after=garbage').status_code, 400)
+            # well formed cursors holding values of the wrong type
+            for cursor in (encode_cursor({"a": 1}, 1), encode_cursor(1, [2])):
+                for sort in ('id', 'year', 'updated', 'title'):
+                    self.assertEqual(c.get(f'/admin/books?sort={sort}&after={cursor}').status_code, 400)
+                # the dashboard page flashes the error and starts over
+                self.assertEqual(c.get(f'/admin/admin?sort=year&after={cursor}').status_code, 302)
+            page = c.get('/admin/admin?sort=author').get_data(as_text=True)
+            self.assertLess(page.index("Collins"), page.index("Hesiod"))
+            self.assertIn('id="dashboard-more"', page)
+
+    def test_dashboard_sorts_use_indexes(self):
+        """
+        Test that every sort order is read from an index instead of sorting the table
+        """
+        for column, _ in SORTS.values():
+            query = db.session.query(*DASHBOARD_COLUMNS).filter(column.isnot(None)).order_by(column, Book.id).limit(10)
+            statement = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+            plan = ' '.join(row[-1] for row in db.session.execute(db.text('EXPLAIN QUERY PLAN ' + statement)))
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+# System tests for the RESTful API
+class ApiTestCase(BaseTestCase):
+    """
+    System test for the API routes
+    """
+    def add_books(self, count):
+        """
+        Method adds a number of books to the db
+        """
+        for i in range(count):
+            db.session.add(Book(title=f"Book {i}", author="Author", synopsis="A synopsis"))
+        db.session.commit()
+
+    def get_token(self, name="username", password="password"):
+        """
+        Method fetches a token for a user through basic auth
+        """
+        with self.client() as c:
+            response = c.get('/api/token', headers={
+                'Authorization': 'Basic ' + base64.b64encode(f"{name}:{password}".encode()).decode()
+            })
+            return response.get_json()['token']
+
+    def test_books_keyset_pagination(self):
+        self.add_books(4)
+        with self.client() as c:
+            response = c.get('/api/books?limit=2')
+            data = response.get_json()
+            self.assertEqual([book['title'] for book in data['books']], ["A book", "Book 0"])
+            self.assertEqual(data['next'], data['books'][-1]['id'])
+            self.assertIn('rel="next"', response.headers['Link'])
+
+            response = c.get(f"/api/books?limit=2&after={data['next']}")
+            data = response.get_json()
+            self.assertEqual([book['title'] for book in data['books']], ["Book 1", "Book 2"])
+
+            response = c.get(f"/api/books?limit=2&after={data['next']}")
+            data = response.get_json()
+            self.assertEqual([book['title'] for book in data['books']], ["Book 3"])
+            self.assertIsNone(data['next'])
+            self.assertNotIn('Link', response.headers)
+
+    def test_books_page_size_is_capped(self):
+        self.app.config['API_MAX_PAGE_SIZE'] = 3
+        self.add_books(5)
+        with self.client() as c:
+            data = c.get('/api/books?limit=100').get_json()
+            self.assertEqual(len(data['books']), 3)
+            self.assertEqual(c.get('/api/books?limit=abc').status_code, 400)
+            self.assertEqual(c.get('/api/books?limit=0').status_code, 400)
+
+    def test_books_stream(self):
+        self.app.config['API_STREAM_BATCH_SIZE'] = 2
+        self.add_books(3)
+        with self.client() as c:
+            response = c.get('/api/books?stream=1')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            titles = [json.loads(line)['title'] for line in response.get_data(as_text=True).splitlines()]
+            self.assertEqual(titles, ["A book", "Book 0", "Book 1", "Book 2"])
+
+            response = c.get('/api/books', headers={'Accept': 'application/x-ndjson'})
+            self.assertEqual(len(response.get_data(as_text=True).splitlines()), 4)
+
+    def test_books_sparse_fieldsets(self):
+        with self.client() as c:
+            data = c.get('/api/books?fields=id,title').get_json()
+            self.assertEqual(list(data['books'][0]), ['id', 'title'])
+
+            data = c.get('/api/books/A book?fields=title,year_of_publish').get_json()
+            self.assertEqual(data['Book'], {'title': "A book", 'Year of publishment': None})
+
+            line = c.get('/api/books?stream=1&fields=title').get_data(as_text=True)
+            self.assertEqual(json.loads(line), {'title': "A book"})
+
+            response = c.get('/api/books?fields=title,password_hash')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('password_hash', response.get_json()['error'])
+
+    def test_search_books(self):
+        db.session.add(Book(title="The Hobbit", author="J. R. R. Tolkien", synopsis="A hobbit goes on a journey"))
+        db.session.add(Book(title="Dragons", author="Someone", synopsis="Includes a hobbit cameo"))
+        db.session.commit()
+        with self.client() as c:
+            data = c.get('/api/books/search?q=hobbit').get_json()
+            self.assertEqual(data['total'], 2)
+            # a match on the title outranks a match on the synopsis
+            self.assertEqual([book['title'] for book in data['books']], ["The Hobbit", "Dragons"])
+
+            data = c.get('/api/books/search?q=hobbit&per_page=1&page=3').get_json()
+            self.assertEqual(data['books'], [])
+            self.assertEqual(c.get('/api/books/search').status_code, 400)
+
+        book = Book.query.filter_by(title="Dragons").first()
+        book.synopsis = "No small folk here"
+        db.session.commit()
+        db.session.delete(Book.query.filter_by(title="The Hobbit").first())
+        db.session.commit()
+        with self.client() as c:
+            data = c.get('/api/books/search?q=hobbit').get_json()
+            self.assertEqual(data['total'], 0)
+
+    def test_case_insensitive_lookups(self):
+        db.session.add(Book(title="The Hobbit", author="J. R. R. Tolkien", synopsis="A journey"))
+        db.session.commit()
+        with self.client() as c:
+            data = c.get('/api/books/the hobbit').get_json()
+            self.assertEqual(data['Book']['title'], "The Hobbit")
+            data = c.get('/api/books/author', json={'author': "j. r. r. TOLKIEN"}).get_json()
+            self.assertEqual(data['book_count'], 1)
+            self.assertEqual(data['author'], "j. r. r. TOLKIEN")
+            # another spelling finds the same books and gets its own name back, not a cached one
+            response = c.get('/api/books/author', json={'author': "J. R. R. Tolkien"})
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(response.get_json()['author'], "J. R. R. Tolkien")
+            self.assertEqual(response.get_json()['book_count'], 1)
+            response = c.get('/api/books/author', json={'author': "J. R. R. Tolkien"})
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertEqual(response.get_json()['author'], "J. R. R. Tolkien")
+
+    def test_lookup_keys_fit_the_longest_casefolded_values(self):
+        """
+        Test that the keys of the longest titles and authors fit, even when casefolding lengthens them
+        """
+        title, author = "ΐ" * Book.title.type.length, "ß" * Book.author.type.length
+        book = Book(title=title, author=author, synopsis="Long names")
+        self.assertLessEqual(len(book.title_key), Book.title_key.type.length)
+        self.assertLessEqual(len(book.author_key), Book.author_key.type.length)
+
+    def test_counters_follow_inserts_and_deletes(self):
+        with self.client() as c:
+            self.assertEqual(c.get('/api/books/count').get_json()["Total number of books"], 1)
+            self.add_books(3)
+            self.assertEqual(c.get('/api/books/count').get_json()["Total number of books"], 4)
+            db.session.delete(Book.query.first())
+            db.session.commit()
+            self.assertEqual(c.get('/api/books/count').get_json()["Total number of books"], 3)
+
+    def test_counters_reconcile(self):
+        Counter.reconcile()
+        Counter.query.get('book').value = 42
+        db.session.commit()
+        self.assertEqual(Counter.reconcile(), {'book': 1, 'user': 1})
+        self.assertEqual(Counter.value_of('book'), 1)
+        # missing counters are created by the first read
+        Counter.query.filter(Counter.name.in_(['book', 'user'])).delete(synchronize_session=False)
+        db.session.commit()
+        self.assertEqual(Counter.value_of('user'), 1)
+        self.assertEqual(Counter.query.get('book').value, 1)
+
+    def test_catalog_etag(self):
+        self.add_admin()
+        token = self.get_token("admin")
+        with self.client() as c:
+            response = c.get('/api/books/count')
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
+
+            response = c.get('/api/books/count', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            # validation relies on the ETag, the version may change twice within a second
+            response = c.get('/api/books/count', headers={'If-Modified-Since': last_modified})
+            self.assertEqual(response.status_code, 200)
+            # another representation of the catalog has a tag of its own
+            self.assertNotEqual(c.get('/api/books/A book').headers['ETag'], etag)
+
+            c.put('/api/books/update/A book', json={'synopsis': "Changed"}, headers={'x-access-token': token})
+            response = c.get('/api/books/count', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_update_copies(self):
+        self.add_admin()
+        token = self.get_token("admin")
+        borrow(1, 1)
+        db.session.commit()
+        with self.client() as c:
+            for copies in (True, -1, "2"):
+                response = c.put('/api/books/update/A book', json={'synopsis': "Changed", 'copies_total': copies},
+                                 headers={'x-access-token': token})
+                self.assertEqual(response.status_code, 400)
+            response = c.put('/api/books/update/A book', json={'synopsis': "Changed", 'copies_total': 0},
+                             headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 400)
+            db.session.rollback()
+            self.assertEqual(Book.query.get(1).synopsis, "A really good read")
+            response = c.put('/api/books/update/A book', json={'copies_total': 3},
+                             headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 200)
+        book = Book.query.get(1)
+        self.assertEqual((book.copies_total, book.copies_available), (3, 2))
+
+    def test_response_cache(self):
+        with self.client() as c:
+            self.assertEqual(c.get('/api/books/A book').headers['X-Cache'], 'MISS')
+            response = c.get('/api/books/A book')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertEqual(response.get_json()['Book']['title'], "A book")
+            self.assertEqual(c.get('/api/books/author', json={'author': "X"}).headers['X-Cache'], 'MISS')
+            self.assertEqual(c.get('/api/books/author', json={'author': "Y"}).headers['X-Cache'], 'MISS')
+
+            book = Book.query.first()
+            book.synopsis = "Changed"
+            db.session.commit()
+            response = c.get('/api/books/A book')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(response.get_json()['Book']['synopsis'], "Changed")
+        self.assertEqual(self.app.response_cache.stats()['hits'], 1)
+
+    def test_sqlite_response_cache_is_shared(self):
+        path = os.path.join(self.app.config['WHOOSH_BASE'], 'cache.db')
+        first, second = SQLiteCache(path, maxsize=2), SQLiteCache(path, maxsize=2)
+        first.set('a', (200, [], b'data'))
+        self.assertEqual(second.get('a'), (200, [], b'data'))
+        first.set('b', 1)
+        first.set('c', 2)
+        self.assertEqual(second.stats()['size'], 2)
+        self.assertIsNone(second.get('expired', None))
+        first.set('d', 3, ttl=-1)
+        self.assertIsNone(second.get('d'))
+
+    def test_bulk_import_endpoint(self):
+        self.add_admin()
+        token = self.get_token("admin")
+        body = "title,author,synopsis,year_of_publish\n" \
+            "Dune,Frank Herbert,Spice,1965\n" \
+            ",Nobody,No title,2000\n" \
+            "Emma,Jane Austen,Matchmaking,eighteen fifteen\n" \
+            "Ulysses,James Joyce,A day in Dublin,1922\n"
+        with self.client() as c:
+            response = c.post('/api/books/bulk?batch_size=2', data=body, content_type='text/csv',
+                              headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 201)
+            report = response.get_json()
+            self.assertEqual(report['inserted'], 2)
+            self.assertEqual([error['row'] for error in report['errors']], [3, 4])
+
+            self.assertEqual(c.get('/api/books/count').get_json()["Total number of books"], 3)
+            self.assertEqual(c.get('/api/books/dune').get_json()['Book']['author'], "Frank Herbert")
+            self.assertEqual(c.get('/api/books/search?q=dublin').get_json()['total'], 1)
+
+            response = c.post('/api/books/bulk', data=body, content_type='text/csv',
+                              headers={'x-access-token': self.get_token()})
+            self.assertEqual(response.status_code, 403)
+
+    def test_bulk_import_size_limit(self):
+        self.add_admin()
+        token = self.get_token("admin")
+        body = "title,synopsis\n" + "".join(f"Book {i},Synopsis\n" for i in range(100))
+        # uploads are capped by MAX_CONTENT_LENGTH, bulk imports by a limit of their own
+        self.app.config['MAX_CONTENT_LENGTH'] = 100
+        with self.client() as c:
+            response = c.post('/api/books/bulk', data=body, content_type='text/csv',
+                              headers={'x-access-token': token})
+            self.assertEqual(response.get_json()['inserted'], 100)
+            self.assertEqual(c.get('/api/books/search?q=synopsis&per_page=200').get_json()['total'], 100)
+            self.app.config['BULK_IMPORT_MAX_CONTENT_LENGTH'] = 100
+            response = c.post('/api/books/bulk', data=body, content_type='text/csv',
+                              headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 413)
+
+    def test_bulk_import_command(self):
+        path = os.path.join(self.app.config['WHOOSH_BASE'], 'books.jsonl')
+        with open(path, 'w') as f:
+            f.write(json.dumps({'title': "Dune", 'synopsis': "Spice"}) + "\n")
+            f.write("not json\n")
+            f.write(json.dumps({'title': "Emma", 'synopsis': "Matchmaking", 'isbn': "1"}) + "\n")
+        result = self.app.test_cli_runner().invoke(args=['books', 'import', path])
+        self.assertIn("1 books imported, 2 rows rejected", result.output)
+        self.assertEqual(Book.query.filter_by(title_key="dune").count(), 1)
+
+    def test_import_row_rejected_by_database(self):
+        db.session.execute(db.text("CREATE TRIGGER reject_book BEFORE INSERT ON book WHEN NEW.title = 'Bad' "
+                                   "BEGIN SELECT RAISE(ABORT, 'internal detail'); END"))
+        db.session.commit()
+        stream = io.StringIO("title,synopsis\nZyzzyva,One\nBad,Two\nZyzzyva,Three\n")
+        report = import_books(stream, 'csv', batch_size=10).to_dict()
+        self.assertEqual(report['inserted'], 2)
+        self.assertEqual(report['errors'], [{'row': 3, 'error': 'rejected by the database'}])
+        # each imported row is indexed once, under its own id
+        books, total = Book.search("zyzzyva", 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(sorted(book.synopsis for book in books), ["One", "Three"])
+
+    def test_loan(self):
+        self.add_books(1)
+        token = self.get_token()
+        with self.client() as c:
+            response = c.post('/api/books/1/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 201)
+            response = c.post('/api/books/1/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(db.session.query(user_book).count(), 1)
+            response = c.post('/api/books/999/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 404)
+            response = c.delete('/api/books/1/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 200)
+            response = c.delete('/api/books/1/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(db.session.query(user_book).count(), 0)
+
+    def test_export_command(self):
+        directory = os.path.join(self.app.config['WHOOSH_BASE'], 'export')
+        db.session.execute(user_book.insert().values(user_id=1, book_id=1))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['export', directory])
+        self.assertIn("1 books exported", result.output)
+        with gzip.open(os.path.join(directory, 'users.jsonl.gz'), 'rt') as f:
+            user = json.loads(f.readline())
+        self.assertEqual(user['name'], "username")
+        self.assertNotIn('password_hash', user)
+        with gzip.open(os.path.join(directory, 'loans.jsonl.gz'), 'rt') as f:
+            self.assertEqual(json.loads(f.readline()), {'user_id': 1, 'book_id': 1})
+
+        self.add_books(1)
+        Book.query.filter_by(title="Book 0").first().updated_at = datetime.datetime(2100, 1, 1)
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['export', directory, '--format', 'csv', '--since', '2099-01-01'])
+        self.assertIn("1 books exported", result.output)
+        self.assertIn("0 users exported", result.output)
+        with gzip.open(os.path.join(directory, 'books.csv.gz'), 'rt') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['title'] for row in rows], ["Book 0"])
+
+        # deleted rows come as tombstones, so consumers can tell them from unchanged ones
+        watermark = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        book_id = Book.query.filter_by(title="Book 0").first().id
+        db.session.delete(Book.query.get(book_id))
+        db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=['export', directory, '--since', watermark])
+        self.assertIn("1 deletions exported", result.output)
+        with gzip.open(os.path.join(directory, 'deletions.jsonl.gz'), 'rt') as f:
+            tombstone = json.loads(f.readline())
+        self.assertEqual((tombstone['table_name'], tombstone['row_id']), ('book', book_id))
+
+    def add_admin(self):
+        """
+        Method adds an admin user to the db
+        """
+        admin = User(name="admin", email="admin@email.com", is_admin=True)
+        admin.set_password("password")
+        db.session.add(admin)
+        db.session.commit()
+        return admin
+
+    def test_token_claims_and_cache(self):
+        token = self.get_token()
+        claims = jwt.decode(token, self.app.config['SECRET_KEY'], algorithms="HS256")
+        self.assertEqual((claims['id'], claims['name'], claims['is_admin']), (1, "username", False))
+        with self.client() as c:
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 200)
+            self.assertEqual(self.app.token_cache.stats()['size'], 1)
+            c.get('/api/books/mine', headers={'x-access-token': token})
+            self.assertEqual(self.app.token_cache.stats()['hits'], 1)
+
+    def test_revocation_reaches_other_workers(self):
+        token = self.get_token()
+        with self.client() as c:
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 200)
+            # another worker revokes the user's tokens, this one notices on its next refresh
+            db.session.add(TokenRevocation(user_id=1, revoked_at=datetime.datetime.utcnow()))
+            db.session.commit()
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 200)
+            self.app.config['TOKEN_REVOCATION_REFRESH'] = 0
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 403)
+            # tokens issued after the revocation are accepted
+            token = self.get_token()
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 200)
+
+    def test_deleted_user_token_is_forgotten(self):
+        self.add_admin()
+        token = self.get_token()
+        admin_token = self.get_token("admin")
+        with self.client() as c:
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 200)
+            c.delete('/api/user/1', headers={'x-access-token': admin_token})
+            self.assertEqual(c.get('/api/books/mine', headers={'x-access-token': token}).status_code, 403)
+
+    def test_db_stats(self):
+        self.add_admin()
+        with self.client() as c:
+            self.assertEqual(c.get('/api/db/stats', headers={'x-access-token': self.get_token()}).status_code, 403)
+            data = c.get('/api/db/stats', headers={'x-access-token': self.get_token("admin")}).get_json()
+            self.assertEqual((data['dialect'], data['pool']), ('sqlite', 'StaticPool'))
+
+    def test_users_keyset_pagination(self):
+        self.add_admin()
+        token = self.get_token("admin")
+        with self.client() as c:
+            data = c.get('/api/users?limit=1', headers={'x-access-token': token}).get_json()
+            self.assertEqual([user['name'] for user in data['users']], ["username"])
+            data = c.get(f"/api/users?limit=1&after={data['next']}", headers={'x-access-token': token}).get_json()
+            self.assertEqual([user['name'] for user in data['users']], ["admin"])
+            self.assertIsNone(data['next'])
+
+
+class RateLimitTestCase(BaseTestCase):
+    """
+    Tests for the token buckets in front of the auth and admin write endpoints
+    """
+    def setUp(self):
+        super().setUp()
+        self.app.config['RATELIMIT_ENABLED'] = True
+        self.app.config['RATELIMIT_AUTH'] = '3/60'
+        self.app.rate_limiter = RateLimiter(self.app.config)
+
+    def get_token(self, name="username", password="password", ip='10.0.0.1'):
+        credentials = base64.b64encode(f"{name}:{password}".encode()).decode()
+        return self.client().get('/api/token', headers={'Authorization': 'Basic ' + credentials},
+                                 environ_base={'REMOTE_ADDR': ip})
+
+    def test_burst_answers_429(self):
+        for _ in range(3):
+            self.assertEqual(self.get_token().status_code, 200)
+        response = self.get_token()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('error', response.get_json())
+        self.assertEqual(response.headers['Retry-After'], '20')
+
+    def test_username_bucket(self):
+        """
+        Test that guessing one account's password from many addresses is limited too
+        """
+        for i in range(3):
+            self.assertEqual(self.get_token(password="wrong", ip=f'10.0.0.{i}').status_code, 401)
+        self.assertEqual(self.get_token(ip='10.0.0.9').status_code, 429)
+        self.assertEqual(self.get_token(name="other", ip='10.0.0.9').status_code, 401)
+
+    def test_form_login(self):
+        for _ in range(3):
+            self.client().post('/auth/login', data={"username": "username", "password": "wrong"})
+        response = self.client().post('/auth/login', data={"username": "username", "password": "password"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '20')
+        self.assertEqual(self.client().get('/auth/login').status_code, 200)
+
+    def test_in_flight_cap(self):
+        self.app.config['RATELIMIT_MAX_IN_FLIGHT'] = 1
+        self.app.rate_limiter = RateLimiter(self.app.config)
+        slot = self.app.rate_limiter.enter()
+        response = self.get_token()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.app.rate_limiter.leave(slot)
+        self.assertEqual(self.get_token().status_code, 200)
+
+    def test_forwarded_client_address(self):
+        """
+        Test that clients behind the same proxy get buckets of their own
+        """
+        for _ in range(3):
+            self.get_token(password="wrong", ip='10.0.0.1')
+        response = self.client().get('/api/token', environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                                     headers={'X-Forwarded-For': '192.0.2.7'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_sqlite_store_is_shared(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ratelimit.db')
+        first, second = SQLiteBucketStore(path), SQLiteBucketStore(path)
+        self.assertEqual(first.take('auth:ip:1', 2, 1 / 30), 0)
+        self.assertEqual(second.take('auth:ip:1', 2, 1 / 30), 0)
+        self.assertGreater(first.take('auth:ip:1', 2, 1 / 30), 29)
+        self.assertEqual(second.take('auth:ip:2', 2, 1 / 30), 0)
+        # the in-flight cap counts the requests of every worker
+        slot = first.enter(2, 30)
+        self.assertIsNotNone(second.enter(2, 30))
+        self.assertIsNone(second.enter(2, 30))
+        first.leave(slot)
+        self.assertIsNotNone(second.enter(2, 30))
+        # requests of killed workers stop counting after the timeout
+        self.assertIsNotNone(first.enter(2, 0))
+
+
+class EngineProfileTestCase(unittest.TestCase):
+    """
+    Tests for the pool and connection settings the engines are created with
+    """
+    def test_sqlite_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'profile.db')
+        app.config['DATABASE_POOL_SIZE'] = 3
+        with app.app_context():
+            self.addCleanup(db.session.remove)
+            pragmas = [db.session.execute(db.text(f'PRAGMA {name}')).scalar()
+                       for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')]
+            self.assertEqual(pragmas, ['wal', 1, 256 * 1024 * 1024, -64000])
+            stats = pool_stats(db.engine)
+            self.assertEqual((stats['pool'], stats['size'], stats['checked_out']), ('QueuePool', 3, 1))
+
+    def test_postgresql_options(self):
+        app = create_app()
+        app.config['DATABASE_STATEMENT_TIMEOUT'] = 5000
+        _, options = db.apply_driver_hacks(app, make_url('postgresql://library@localhost/library'), {})
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_recycle'], options['pool_pre_ping']),
+                         (5, 10, 1800, True))
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """
+    Tests for the routing of reads to a replica, played by a copy of the primary's SQLite
+    file that misses the primary's latest book, as a lagging replica would
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app = create_app()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'primary.db')
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica0': 'sqlite:///' + os.path.join(directory, 'replica.db')}
+        self.app.config['DATABASE_REPLICAS'] = ['replica0']
+        self.app.config['WHOOSH_BASE'] = os.path.join(directory, 'whoosh')
+        self.app.response_cache = None
+        with self.app.app_context():
+            db.create_all()
+            user = User(name="username", email="username@email.com")
+            user.set_password("password")
+            db.session.add_all([user, Book(title="A book", synopsis="A really good read")])
+            db.session.commit()
+            Counter.catalog_version()
+            db.session.remove()
+            # closing the connections checkpoints the WAL into the file
+            db.engine.dispose()
+            shutil.copy(os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica.db'))
+            db.session.add(Book(title="Another book", synopsis="Only on the primary so far"))
+            db.session.commit()
+        self.addCleanup(self.dispose)
+
+    def dispose(self):
+        with self.app.app_context():
+            db.session.remove()
+            for bind in (None, 'replica0'):
+                db.get_engine(bind=bind).dispose()
+
+    def titles(self, c):
+        return [book['title'] for book in c.get('/api/books').get_json()['books']]
+
+    def test_reads_go_to_replica(self):
+        with self.app.test_client() as c:
+            self.assertEqual(self.titles(c), ["A book"])
+
+    def test_read_your_writes(self):
+        with self.app.test_client() as c:
+            token = c.get('/api/token', headers={
+                'Authorization': 'Basic ' + base64.b64encode(b"username:password").decode()}).get_json()['token']
+            response = c.post('/api/books/1/loan', headers={'x-access-token': token})
+            self.assertEqual(response.status_code, 201)
+            self.assertIn('read_primary_until', response.headers['Set-Cookie'])
+            self.assertEqual(self.titles(c), ["A book", "Another book"])
+            # once the window is over the client reads from the replica again
+            c.set_cookie('localhost', 'read_primary_until', '0')
+            self.assertEqual(self.titles(c), ["A book"])
+
+    def test_read_your_writes_without_cookies(self):
+        """
+        Test that API clients that don't send cookies back read their writes by the user they act for
+        """
+        c = self.app.test_client(use_cookies=False)
+        response = c.post('/api/user', json={"name": "Newcomer", "email": "new@email.com", "password": "password"})
+        self.assertEqual(response.status_code, 201)
+        token = c.get('/api/token', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b"Newcomer:password").decode()}).get_json()['token']
+        self.assertEqual(self.titles(c), ["A book"])
+        self.assertEqual(c.post('/api/books/1/loan', headers={'x-access-token': token}).status_code, 201)
+        books = c.get('/api/books/mine', headers={'x-access-token': token}).get_json()['books']
+        self.assertEqual([book['title'] for book in books], ["A book"])
+        # other clients still read from the replica
+        other = c.get('/api/token', headers={
+            'Authorization': 'Basic ' + base64.b64encode(b"username:password").decode()}).get_json()['token']
+        self.assertEqual([book['title'] for book in c.get('/api/books', headers={'x-access-token': other})
+                          .get_json()['books']], ["A book"])
+
+    def test_request_reads_its_own_writes(self):
+        with self.app.test_request_context('/', method='GET'):
+            self.app.preprocess_request()
+            self.assertEqual(Book.query.count(), 1)
+            db.session.add(Book(title="Third book", synopsis="Written in a GET request"))
+            db.session.flush()
+            self.assertEqual(Book.query.count(), 3)
+            db.session.rollback()
+
+    def test_without_replicas(self):
+        self.app.config['DATABASE_REPLICAS'] = []
+        with self.app.test_client() as c:
+            self.assertEqual(self.titles(c), ["A book", "Another book"])
+
+
+class CheckoutStressTestCase(unittest.TestCase):
+    """
+    Concurrency test for checkouts, with many users borrowing the same book at once
+    Runs against a SQLite file, and against PostgreSQL when TEST_POSTGRES_URL is set
+    """
+    USERS = 24
+    COPIES = 5
+
+    def checkout_rush(self, url):
+        """
+        Lets every user try to borrow the book at the same moment, then return it
+        """
+        app = create_app()
+        app.config['SQLALCHEMY_DATABASE_URI'] = url
+        app.config['WHOOSH_BASE'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, app.config['WHOOSH_BASE'])
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            self.addCleanup(self.drop_all, app)
+            db.session.add(Book(title="Popular", synopsis="Everyone wants it", copies_total=self.COPIES))
+            for i in range(self.USERS):
+                db.session.add(User(name=f"user{i}", email=f"user{i}@email.com"))
+            db.session.commit()
+            book_id = Book.query.first().id
+            user_ids = [user.id for user in User.query.all()]
+
+        barrier = threading.Barrier(self.USERS)
+        outcomes = []
+
+        def attempt(user_id, action):
+            with app.app_context():
+                barrier.wait()
+                try:
+                    outcomes.append(action(user_id, book_id))
+                    db.session.commit()
+                except BookUnavailable:
+                    db.session.rollback()
+                    outcomes.append(None)
+                finally:
+                    db.session.remove()
+
+        for action in (borrow, give_back):
+            outcomes.clear()
+            threads = [threading.Thread(target=attempt, args=(user_id, action)) for user_id in user_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(outcomes), self.USERS)
+            self.assertEqual(outcomes.count(True), self.COPIES)
+            with app.app_context():
+                book = Book.query.get(book_id)
+                loans = db.session.query(user_book).count()
+                self.assertEqual(loans, 0 if action is give_back else self.COPIES)
+                self.assertEqual(book.copies_available, self.COPIES - loans)
+
+    def drop_all(self, app):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_sqlite(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.checkout_rush('sqlite:///' + os.path.join(directory, 'stress.db'))
+
+    def test_postgresql(self):
+        url = os.environ.get('TEST_POSTGRES_URL')
+        if not url:
+            self.skipTest("TEST_POSTGRES_URL is not set")
+        self.checkout_rush(url)
+
+
 if __name__ == "__main__":
     unittest.main()